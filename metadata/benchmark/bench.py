@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+#
+# Offline benchmark of the metadata ingesters.
+#
+# Starts a fake Onezone/Oneprovider and runs one of the ingesters against it,
+# with OnedataFS replaced by a stand-in backed by a local directory. Files are
+# created from the bundled samples at a given rate and announced in the changes
+# stream. Throughput, per-step latency percentiles (taken from jsonLog lines)
+# and peak RSS of the ingester (with its child processes) are reported. See README.md for examples.
+
+import os, sys, re, json, time, glob, shutil, signal, argparse, tempfile, threading, subprocess
+
+benchmarkPath = os.path.dirname(os.path.abspath(__file__))
+metadataPath = os.path.dirname(benchmarkPath)
+sys.path.insert(0, benchmarkPath)
+
+# Configure logging
+import logging as l
+l.basicConfig(level=l.INFO, format='%(message)s')
+
+INGESTERS = ["changes-stream", "changes-stream-ecrin", "space-traverse"]
+
+# Ingesters which find files by traversing the space, files are all created before they start
+TRAVERSING = ["space-traverse"]
+
+# Files each ingester is able to process, used when no --template is given
+DEFAULT_TEMPLATES = {
+  "changes-stream": [os.path.join(metadataPath, "changes-stream", "files_with_metadata", "*.hdf5"),
+                     os.path.join(metadataPath, "changes-stream", "files_with_metadata", "*.fits.fz")],
+  "changes-stream-ecrin": [],
+  "space-traverse": [os.path.join(metadataPath, "changes-stream", "files_with_metadata", "*.hdf5"),
+                     os.path.join(metadataPath, "changes-stream", "files_with_metadata", "*.fits.fz")],
+}
+
+# Timings reported by the ingesters in jsonLog lines
+TIMINGS = ["fileOpenTime", "filegetInfoTime", "metadataExtrationTime", "metadataSettingTime",
+           "fileCloseTime", "getAccessTypeTime", "wholeTime", "endToEndTime"]
+
+# Run an ingester script with fs.onedatafs replaced by the local stand-in
+def runIngester(script):
+  import types, runpy, fs, fakeonedatafs
+  module = types.ModuleType('fs.onedatafs')
+  module.OnedataFS = fakeonedatafs.OnedataFS
+  sys.modules['fs.onedatafs'] = module
+  fs.onedatafs = module
+  sys.argv = [script]
+  runpy.run_path(script, run_name='__main__')
+
+def percentile(values, p):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+def processPeakRss(pid):
+  try:
+    with open("/proc/{}/status".format(pid)) as f:
+      for line in f:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1]) * 1024
+  except (IOError, OSError):
+    pass
+  return None
+
+# Processes started by a process and by them, e.g. extraction processes of an ingester
+def descendants(pid):
+  children = {}
+  for entry in os.listdir("/proc"):
+    if not entry.isdigit():
+      continue
+    try:
+      with open("/proc/{}/stat".format(entry)) as f:
+        stat = f.read()
+    except (IOError, OSError):
+      continue
+    # the parent pid follows the state, after the name in parentheses which may contain anything
+    children.setdefault(int(stat.rsplit(")", 1)[1].split()[1]), []).append(int(entry))
+  found, stack = [], [pid]
+  while stack:
+    for child in children.get(stack.pop(), []):
+      found.append(child)
+      stack.append(child)
+  return found
+
+# Peak RSS of a process with all its descendants, None if it is gone
+def peakRss(pid):
+  peak = processPeakRss(pid)
+  if peak is None:
+    return None
+  return peak + sum(processPeakRss(child) or 0 for child in descendants(pid))
+
+# Write one synthetic file of at least `size` bytes from a template
+def createFile(template, path, size, index):
+  directory = os.path.dirname(path)
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  if template is None:
+    payload = json.dumps({ "index": index, "created": time.time(), "padding": "x" * max(0, size - 64) })
+    with open(path, "w") as f:
+      f.write(payload)
+    return
+  shutil.copyfile(template, path)
+  missing = size - os.path.getsize(path)
+  if missing > 0:
+    with open(path, "ab") as f:
+      f.write(b"\0" * missing)
+
+class Benchmark(object):
+    def __init__(self, options):
+      self.options = options
+      self.created = {}
+      self.processed = []
+      self.lock = threading.Lock()
+      self.done = threading.Event()
+      self.peakRss = 0
+
+    def templates(self):
+      patterns = self.options.template or DEFAULT_TEMPLATES[self.options.ingester]
+      templates = sorted(path for pattern in patterns for path in glob.glob(pattern))
+      if self.options.ingester == "changes-stream-ecrin" and not self.options.template:
+        templates = [None]
+      if not templates:
+        raise SystemExit("No template files match {}".format(patterns))
+      return templates
+
+    # Names of the fake spaces, files are spread over them
+    def spaces(self):
+      return [self.options.space] + ["{}-{}".format(self.options.space, i) for i in range(2, self.options.spaces + 1)]
+
+    def generate(self, provider, fsRoot):
+      spaces = self.spaces()
+      templates = self.templates()
+      interval = 1.0 / self.options.rate if self.options.rate > 0 else 0
+      start = time.time()
+      for i in range(self.options.files):
+        template = templates[i % len(templates)]
+        suffix = ".json" if template is None else os.path.basename(template).split('.', 1)[1]
+        relativePath = "dir{:03d}/file{:07d}.{}".format(i % self.options.directories, i, suffix)
+        space = spaces[i % len(spaces)]
+        createFile(template, os.path.join(fsRoot, space, relativePath), self.options.size, i)
+        with self.lock:
+          self.created["/{}/{}".format(space, relativePath)] = time.time()
+        provider.changed(relativePath, space=space)
+        # keep the requested rate of changes
+        delay = start + (i + 1) * interval - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      self.generated = time.time()
+
+    def readOutput(self, stream, logFile):
+      for line in iter(stream.readline, b''):
+        line = line.decode('utf-8', 'replace')
+        with self.lock:
+          logFile.write(line)
+        match = re.search(r'jsonLog: (\{.*\})', line)
+        if not match:
+          continue
+        record = json.loads(match.group(1))
+        now = time.time()
+        with self.lock:
+          created = self.created.get(record.get("file"))
+          if created is not None:
+            record["endToEndTime"] = now - created
+          record["processed"] = now
+          self.processed.append(record)
+          if len(self.processed) >= self.options.files:
+            self.done.set()
+
+    def run(self):
+      from fakeprovider import FakeProvider
+      replaying = self.options.replay is not None
+      workDir = self.options.replay or tempfile.mkdtemp(prefix="onedata-bench-")
+      fsRoot = os.path.join(workDir, "fs")
+      if not replaying:
+        for space in self.spaces():
+          os.makedirs(os.path.join(fsRoot, space))
+      provider = FakeProvider(self.spaces()).start()
+
+      env = dict(os.environ)
+      env.update({
+        "ONEZONE_HOST": provider.url, "ONECLIENT_PROVIDER_HOST": provider.url,
+        "SPACE_NAME": self.options.space, "ONECLIENT_ACCESS_TOKEN": "benchmark",
+        "ONECLIENT_INSECURE": "true", "LAST_SEQUENCE": "0",
+        "BENCH_FS_ROOT": fsRoot, "BENCH_PROVIDER_URL": provider.url,
+        "PYTHONPATH": os.pathsep.join([metadataPath, benchmarkPath, env.get("PYTHONPATH", "")]),
+      })
+      if self.options.spaces > 1:
+        env["SPACE_NAMES"] = ",".join(self.spaces())
+      if self.options.record:
+        env["RECORD_DIR"] = os.path.join(workDir, "recording")
+      if replaying:
+        # files of the recorded run are there already, changes come from its recording
+        env["REPLAY_DIR"] = os.path.join(workDir, "recording")
+      for assignment in self.options.env:
+        key, value = assignment.split("=", 1)
+        env[key] = value
+
+      script = os.path.join(metadataPath, self.options.ingester, "run.py")
+      logPath = os.path.join(workDir, "ingester.log")
+      traversing = self.options.ingester in TRAVERSING
+      if traversing and not replaying:
+        l.info("Creating {} files in {}".format(self.options.files, fsRoot))
+        self.generate(provider, fsRoot)
+      shards = self.options.shards
+      l.info("Running {} in {}, log in {}{}".format(self.options.ingester, workDir, logPath,
+                                                    " as {} shards".format(shards) if shards > 1 else ""))
+      start = time.time()
+      ingesters = []
+      for index in range(shards):
+        if shards > 1:
+          env.update(SHARD_COUNT=str(shards), SHARD_INDEX=str(index))
+        ingesters.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-ingester", script],
+                                          cwd=workDir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+      running = lambda: any(ingester.poll() is None for ingester in ingesters)
+      # shards run at the same time, so their peak RSS adds up
+      rss = lambda: sum(peakRss(ingester.pid) or 0 for ingester in ingesters if ingester.poll() is None)
+      with open(logPath, "w") as logFile:
+        readers = []
+        for ingester in ingesters:
+          reader = threading.Thread(target=self.readOutput, args=(ingester.stdout, logFile))
+          reader.daemon = True
+          reader.start()
+          readers.append(reader)
+        if not traversing and not replaying:
+          generator = threading.Thread(target=self.generate, args=(provider, fsRoot))
+          generator.daemon = True
+          generator.start()
+
+        deadline = start + self.options.timeout
+        while not self.done.is_set() and time.time() < deadline and running():
+          self.peakRss = max(self.peakRss, rss())
+          self.done.wait(0.5)
+        self.peakRss = max(self.peakRss, rss())
+        if running():
+          if self.options.record:
+            # let the recorder flush the end of the stream
+            time.sleep(2)
+          for ingester in ingesters:
+            if ingester.poll() is None:
+              ingester.send_signal(signal.SIGTERM)
+          for ingester in ingesters:
+            ingester.wait()
+        for reader in readers:
+          reader.join(5)
+      provider.stop()
+      self.report(start)
+      if not self.options.keep and not self.options.record and not replaying:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    def report(self, start):
+      with self.lock:
+        processed = list(self.processed)
+      elapsed = (max(r["processed"] for r in processed) - start) if processed else 0
+      result = {
+        "ingester": self.options.ingester, "files": self.options.files, "processed": len(processed),
+        "elapsed": elapsed, "filesPerSecond": len(processed) / elapsed if elapsed else 0,
+        "peakRssBytes": self.peakRss,
+      }
+      for name in TIMINGS:
+        values = [r[name] for r in processed if name in r]
+        result[name] = { "p50": percentile(values, 50), "p99": percentile(values, 99) }
+
+      print("")
+      print("Ingester: {ingester}, processed {processed}/{files} files in {elapsed:.2f}s, "
+            "{filesPerSecond:.2f} files/s, peak RSS {0:.1f} MiB".format(self.peakRss / 1048576.0, **result))
+      print("{:<24} {:>12} {:>12}".format("timing", "p50 [s]", "p99 [s]"))
+      for name in TIMINGS:
+        if result[name]["p50"] is not None:
+          print("{:<24} {:>12.6f} {:>12.6f}".format(name, result[name]["p50"], result[name]["p99"]))
+      print("benchResult: {}".format(json.dumps(result)))
+      if self.options.output:
+        with open(self.options.output, "w") as f:
+          json.dump(result, f, indent=2)
+
+def main():
+  if len(sys.argv) == 3 and sys.argv[1] == "--run-ingester":
+    runIngester(sys.argv[2])
+    return
+  parser = argparse.ArgumentParser(description="Benchmark a metadata ingester against a local fake Onedata provider.")
+  parser.add_argument("--ingester", choices=INGESTERS, default="changes-stream")
+  parser.add_argument("--files", type=int, default=200, help="number of files to create")
+  parser.add_argument("--rate", type=float, default=0, help="files created per second, 0 creates them as fast as possible")
+  parser.add_argument("--size", type=int, default=0, help="minimal size of each file in bytes, templates are padded with zeros")
+  parser.add_argument("--directories", type=int, default=10, help="number of directories files are spread over")
+  parser.add_argument("--template", action="append", help="glob of template files, can be repeated")
+  parser.add_argument("--space", default="bench-space", help="name of the fake space")
+  parser.add_argument("--spaces", type=int, default=1,
+                      help="number of fake spaces files are spread over, all ingested by one process")
+  parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the ingester, can be repeated")
+  parser.add_argument("--timeout", type=float, default=600, help="give up after this many seconds")
+  parser.add_argument("--output", help="save results as JSON to this file")
+  parser.add_argument("--keep", action="store_true", help="keep the working directory with files and the ingester log")
+  parser.add_argument("--record", action="store_true",
+                      help="record the changes stream in the working directory, which is kept to be replayed")
+  parser.add_argument("--replay", metavar="WORKDIR",
+                      help="replay the changes stream recorded in the working directory of a run with --record, "
+                           "over its files, instead of creating files")
+  parser.add_argument("--shards", type=int, default=1,
+                      help="split the ingestion between this many processes, each ingesting its shard of the files")
+  options = parser.parse_args()
+  if options.shards > 1 and (options.record or options.ingester in TRAVERSING):
+    parser.error("--shards works with changes stream ingesters and without --record")
+  if options.spaces > 1 and options.ingester != "changes-stream":
+    parser.error("--spaces works with the changes-stream ingester")
+  Benchmark(options).run()
+
+if __name__ == "__main__":
+  main()
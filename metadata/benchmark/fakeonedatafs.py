@@ -0,0 +1,80 @@
+import os, threading
+try:
+  from urllib2 import urlopen, Request, quote
+except ImportError:
+  from urllib.request import urlopen, Request
+  from urllib.parse import quote
+
+from fs.osfs import OSFS
+from fs.errors import ResourceNotFound
+
+# Configure logging
+import logging as l
+
+# File opened through the stand-in, named by its path in the filesystem like OnedataFS files are
+class OnedataFile(object):
+    def __init__(self, file, path):
+      self.file = file
+      self.path = self.name = path
+
+    def __getattr__(self, name):
+      return getattr(self.file, name)
+
+    def __iter__(self):
+      return iter(self.file)
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *args):
+      self.file.close()
+
+# Stand-in for fs.onedatafs.OnedataFS backed by a local directory.
+#
+# The directory is taken from BENCH_FS_ROOT, its subdirectories play the role
+# of spaces. Extended attributes are kept in memory. When BENCH_PROVIDER_URL
+# is set, every setxattr is reported to the fake provider, so it appears in
+# the changes stream like a metadata write on a real provider does.
+class OnedataFS(OSFS):
+    def __init__(self, host, token, *args, **kwargs):
+      super(OnedataFS,self).__init__(os.environ['BENCH_FS_ROOT'])
+      self.providerUrl = os.environ.get('BENCH_PROVIDER_URL')
+      self.xattrs = {}
+      self.xattrsLock = threading.Lock()
+
+    # OnedataFS accepts byte string paths, python2 scripts pass them all the time
+    def validatepath(self, path):
+      if isinstance(path, bytes):
+        path = path.decode('utf-8')
+      return super(OnedataFS,self).validatepath(path)
+
+    def openbin(self, path, mode="r", buffering=-1, **options):
+      return OnedataFile(super(OnedataFS,self).openbin(path, mode, buffering, **options), self.validatepath(path))
+
+    def open(self, path, mode="r", *args, **kwargs):
+      return OnedataFile(super(OnedataFS,self).open(path, mode, *args, **kwargs), self.validatepath(path))
+
+    def setxattr(self, path, name, value):
+      path = self.validatepath(path)
+      if isinstance(name, bytes):
+        name = name.decode('utf-8')
+      if not self.exists(path):
+        raise ResourceNotFound(path)
+      with self.xattrsLock:
+        self.xattrs[(path, name)] = value
+      if self.providerUrl:
+        try:
+          urlopen(Request("{}/fake/changed/{}".format(self.providerUrl, quote(path.lstrip('/'))), data=b"")).read()
+        except Exception as e:
+          l.debug("Reporting change of {} failed: {}".format(path, e))
+
+    def getxattr(self, path, name):
+      path = self.validatepath(path)
+      if isinstance(name, bytes):
+        name = name.decode('utf-8')
+      if name == "org.onedata.access_type":
+        return b"direct"
+      with self.xattrsLock:
+        if (path, name) not in self.xattrs:
+          raise ResourceNotFound(path)
+        return self.xattrs[(path, name)]
@@ -0,0 +1,127 @@
+import json, time, threading
+from collections import OrderedDict
+try:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+  from urlparse import urlparse, parse_qs
+  from urllib import unquote
+except ImportError:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+  from urllib.parse import urlparse, parse_qs, unquote
+
+# Configure logging
+import logging as l
+
+# Local stand-in for Onezone and Oneprovider REST endpoints used by the ingesters:
+#
+#  GET  /api/v3/onezone/user/spaces
+#  GET  /api/v3/onezone/spaces/{id}
+#  POST /api/v3/oneprovider/changes/metadata/{spaceId}?timeout=...&last_seq=...
+#
+# Changes are kept in memory and streamed as newline delimited JSON, the
+# stream ends after `timeout` milliseconds without a new change, as on a real
+# provider. POST /fake/changed/{space}/{path} lets the fake OnedataFS report
+# metadata writes, so they show up in the stream like they do on a real provider.
+# Given a list of names, the provider supports several spaces, each with its own
+# stream; the first one has `spaceId`, the others have it suffixed with a number.
+class FakeProvider(object):
+    def __init__(self, spaceName, spaceId="fakespaceid", host="127.0.0.1", port=0):
+      spaceNames = [spaceName] if not isinstance(spaceName, list) else spaceName
+      self.spaceName = spaceNames[0]
+      self.spaceId = spaceId
+      self.spaceIds = OrderedDict((name, spaceId if i == 0 else "{}{}".format(spaceId, i)) for i, name in enumerate(spaceNames))
+      self.changes = dict((id, []) for id in self.spaceIds.values())
+      self.condition = threading.Condition()
+      self.streamsOpened = 0
+      provider = self
+      spaceNamesById = dict((id, name) for name, id in self.spaceIds.items())
+
+      class Handler(BaseHTTPRequestHandler):
+          def do_GET(self):
+            path = urlparse(self.path).path
+            spaceId = path.rsplit('/', 1)[-1]
+            if path == "/api/v3/onezone/user/spaces":
+              self.sendJSON({ "spaces": list(provider.spaceIds.values()) })
+            elif path == "/api/v3/onezone/spaces/{}".format(spaceId) and spaceId in spaceNamesById:
+              self.sendJSON({ "name": spaceNamesById[spaceId], "spaceId": spaceId,
+                              "providers": { "fakeprovider": 10**12 } })
+            else:
+              self.send_error(404)
+
+          def do_POST(self):
+            url = urlparse(self.path)
+            spaceId = url.path.rsplit('/', 1)[-1]
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if url.path == "/api/v3/oneprovider/changes/metadata/{}".format(spaceId) and spaceId in spaceNamesById:
+              query = parse_qs(url.query)
+              timeout = float(query.get('timeout', ['60000'])[0]) / 1000
+              lastSeq = int(query.get('last_seq', ['0'])[0])
+              self.send_response(200)
+              self.send_header('Content-Type', 'application/json')
+              self.end_headers()
+              provider.stream(self.wfile, lastSeq, timeout, spaceId)
+            elif url.path.startswith("/fake/changed/"):
+              space, _, path = unquote(url.path[len("/fake/changed/"):]).partition('/')
+              provider.changed(path, space=space)
+              self.sendJSON({})
+            else:
+              self.send_error(404)
+
+          def sendJSON(self, body):
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+          def log_message(self, format, *args):
+            pass
+
+      class Server(ThreadingMixIn, HTTPServer):
+          daemon_threads = True
+
+      self.server = Server((host, port), Handler)
+      self.url = "http://{}:{}".format(host, self.server.server_address[1])
+
+    def start(self):
+      thread = threading.Thread(target=self.server.serve_forever, name='fakeprovider')
+      thread.daemon = True
+      thread.start()
+      return self
+
+    def stop(self):
+      self.server.shutdown()
+
+    # Record a change of the file at path (relative to the root of the space, the first one by default)
+    def changed(self, path, deleted=False, space=None):
+      space = space or self.spaceName
+      with self.condition:
+        changes = self.changes[self.spaceIds[space]]
+        seq = len(changes) + 1
+        changes.append(json.dumps({
+          "seq": seq, "fileId": "{:016x}".format(seq),
+          "filePath": "/{}/{}".format(space, path.lstrip('/')),
+          "fileMeta": { "rev": "1-{}".format(seq), "mutators": ["fakeprovider"], "changed": True,
+                        "deleted": deleted, "fields": { "deleted": deleted } } }))
+        self.condition.notify_all()
+        return seq
+
+    def stream(self, out, lastSeq, timeout, spaceId=None):
+      self.streamsOpened += 1
+      changes = self.changes[spaceId or self.spaceId]
+      index = max(lastSeq - 1, 0)
+      try:
+        while True:
+          with self.condition:
+            if index >= len(changes):
+              self.condition.wait(timeout)
+            batch = changes[index:]
+          if not batch:
+            return
+          index += len(batch)
+          out.write(("\n".join(batch) + "\n").encode('utf-8'))
+          out.flush()
+      except (IOError, OSError) as e:
+        l.debug("Changes stream closed by the client: {}".format(e))
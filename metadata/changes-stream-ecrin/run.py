@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-import os, sys, json, time
-import threading, Queue, concurrent.futures
+import os, sys, re, time, signal
+import Queue
 
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -11,8 +11,21 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 # Onedatafs for data access
 from fs.onedatafs import OnedataFS
 
-# CTA Extractor
-from onedatacustom.metadataextractor import MetaDataExtractorHdf5
+# Shared ingestion building blocks
+from onedataingest.changes import ChangesListener, Change
+from onedataingest.recording import StreamRecorder, ReplayListener
+from onedataingest.rest import RestClient, SpaceCache
+from onedataingest.pipeline import Pipeline
+from onedataingest.stages import IngestionStages, stage
+from onedataingest.concurrency import AimdController
+from onedataingest.coalesce import Coalescer
+from onedataingest.spillqueue import SpillQueue
+from onedataingest.digests import IngestedFiles
+from onedataingest.fileindex import FileIndex
+from onedataingest.checkpoint import CheckpointTracker
+from onedataingest.sharding import shardFilter, shardDirectory, shardFile, CHECKPOINT
+from onedataingest.metrics import IngestionMetrics
+from onedataingest.extractors import createRegistry
 
 # Configure logging
 import logging as l
@@ -32,206 +45,144 @@ if 'LAST_SEQUENCE' in os.environ:
 else:
   initialStartingSequence=None
 
-# Number od worker threads
-numberOfWorkers=3
+# Formats of files to ingest, the whole content of json files becomes their metadata
+extractorNames=os.environ.get('EXTRACTORS', 'json').split(',')
+extractorOptions={ 'fits': dict(maxHdus=int(os.environ.get('FITS_MAX_HDUS', 32))),
+                   'json': dict(maxSize=int(os.environ.get('JSON_MAX_SIZE', 16 * 1024 * 1024))) }
 
-# Space id will be inferred from Onezone based on space name
-spaceId=""
+# Number of workers of each stage adapts to the latency of the provider, within <STAGE>_MIN_WORKERS
+# and <STAGE>_MAX_WORKERS. With ADAPTIVE_CONCURRENCY=false stages keep <STAGE>_WORKERS workers.
+adaptiveConcurrency=os.environ.get('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+
+# Port of the HTTP endpoint serving metrics in Prometheus format, 0 disables it
+metricsPort=int(os.environ.get('METRICS_PORT', 0))
+# Log timings of every processed file as a jsonLog line
+jsonLogEnabled=os.environ.get('JSON_LOG', 'true').lower() == 'true'
+
+# Space id will be inferred from Onezone based on space name, unless SPACE_ID is given
+spaceId=os.environ.get('SPACE_ID', "")
+
+# With RECORD_DIR the raw changes stream is saved in compressed segment files in this directory.
+# With REPLAY_DIR changes are read from such a recording instead of the provider, starting from
+# LAST_SEQUENCE, at full speed or at REPLAY_SPEED times the recorded rate; the ingestion ends with it.
+recordDir=os.environ.get('RECORD_DIR')
+replayDir=os.environ.get('REPLAY_DIR')
+replaySpeed=float(os.environ.get('REPLAY_SPEED', 0))
+
+# With SHARD_COUNT > 1 the ingestion is split between processes, this one only ingests files
+# whose path hashes to SHARD_INDEX. Run them with: python -m onedataingest.sharding run.py
+shardCount=int(os.environ.get('SHARD_COUNT', 1))
+shardIndex=int(os.environ.get('SHARD_INDEX', 0))
 
 myChangesListener = None
 
-# Initialize a Queue for threads to communicate. 
-# During tests the queue never reached size more then 10k
-BUF_SIZE = 1000000
-q = Queue.Queue(BUF_SIZE)
-
-# Map translating random thread ids to sequential worker numbers
-threadIdToWorkerNumberMap={}
-
-# List of sequence number of each worker thread
-threadsSequenceNumbers=[None]*numberOfWorkers
-
-# List of filehandles for threads to save their state
-fileHandles = []
-
-# timmer
-fileHandlesTimer = None
-
-# Get spaceId from the space name
-with requests.Session() as session:
-  session.headers.update({'X-Auth-Token': apiToken })
-  url="{}/api/v3/onezone/user/spaces".format(onezoneUrl)
-  response = session.get(url,verify=False)
-
-  for space in response.json()['spaces']:
-    url="{}/api/v3/onezone/spaces/{}".format(onezoneUrl,space)
-    response = session.get(url,verify=False)
-    if response.json()['name'] == sourceSpaceName:
-      if spaceId=="":
-        spaceId=response.json()['spaceId']
-      else:
-        print("Error more then 1 space of name={} exists in the provider {}".format(sourceSpaceName,sourceProvider))
-        sys.exit(1)
-  if spaceId=="":
+# Initialize a bounded Queue for threads to communicate. When it is full
+# the changes listener stops reading the stream until workers catch up
+BUF_SIZE = int(os.environ.get('QUEUE_SIZE', 1000))
+# With QUEUE_DIR changes are queued in segment files in this directory, only
+# QUEUE_SIZE of them are kept in memory. The listener is never held back
+# and queued changes are processed after a restart.
+queueDir = os.environ.get('QUEUE_DIR')
+if queueDir and shardCount > 1:
+  queueDir = shardDirectory(queueDir, shardIndex, shardCount)
+if queueDir:
+  changesQueue = SpillQueue(queueDir, memoryItems=BUF_SIZE, segmentItems=int(os.environ.get('QUEUE_SEGMENT_ITEMS', 10000)),
+                            decode=lambda values: Change(*values))
+else:
+  changesQueue = Queue.Queue(BUF_SIZE)
+
+# Changes of the same file arriving within this many seconds are merged
+# into one, 0 (the default) passes every change to workers without delay
+coalesceWindow = float(os.environ.get('COALESCE_WINDOW', 0))
+coalescer = None
+q = changesQueue
+if coalesceWindow > 0:
+  q = Queue.Queue(BUF_SIZE)
+  coalescer = Coalescer(changesQueue, q, coalesceWindow, maxPending=int(os.environ.get('COALESCE_MAX_PENDING', 100000)),
+                        onMerged=lambda change: changeDone(change))
+
+# One pool of keep-alive connections for all REST calls of the script
+client = RestClient(onezoneUrl, apiToken)
+
+# Get spaceId from the space name, unless it is given or not needed for a replay
+if spaceId=="" and not replayDir:
+  spaceCachePath=os.environ.get('SPACE_CACHE_PATH')
+  spaceCache=SpaceCache(spaceCachePath, ttl=float(os.environ.get('SPACE_CACHE_TTL', 86400))) if spaceCachePath else None
+  spaceIds=client.spaceIds(sourceSpaceName, cache=spaceCache)
+  if len(spaceIds) > 1:
+    print("Error more then 1 space of name={} exists in the provider {}".format(sourceSpaceName,sourceProvider))
+    sys.exit(1)
+  if not spaceIds:
     print("No space of name={} exists in the provider {}".format(sourceSpaceName,sourceProvider))
     sys.exit(1)
-  print("Space name={} spaceId={}".format(sourceSpaceName,spaceId))
-
-# Changes stream is consumed in a separate thread
-class ChangesListener(threading.Thread):
-    def __init__(self, group=None, target=None, name=None, startingSequenceNumber=None,
-                 args=(), kwargs=None, verbose=None):
-        super(ChangesListener,self).__init__(target=target, name=name, verbose=verbose)
-        self.args = args
-        self.kwargs = kwargs
-        self.startingSequenceNumber = startingSequenceNumber
-
-    def run(self):
-      # Start listening the changes API
-      changesJSON='{ "fileMeta": { "fields": ["name", "type", "deleted"], "always": true }}'
-
-      # Supply extra argument in the url if events should start from a designated sequence
-      if self.startingSequenceNumber == None:
-        urlTemplate = "https://{}/api/v3/oneprovider/changes/metadata/{}?timeout=60000"
-      else:
-        urlTemplate = "https://{}/api/v3/oneprovider/changes/metadata/{}?timeout=60000&last_seq={}"
-      print(self.startingSequenceNumber,urlTemplate)
-      while True:
-        with requests.Session() as session:
-          session.headers.update({'X-Auth-Token': apiToken })
-          session.headers.update({'content-type': 'application/json' })
-          url=urlTemplate.format(sourceProvider,spaceId,self.startingSequenceNumber)
-          response = session.post(url,data=changesJSON,verify=False,stream=True)
-
-          lines = response.iter_lines()
-          for line in lines:
-            if line:
-                decoded_line = json.loads(line.decode('utf-8'))
-                self.startingSequenceNumber = decoded_line["seq"]
-                if decoded_line["fileMeta"]["changed"] and not decoded_line["fileMeta"]["deleted"]:
-                  filePath=decoded_line['filePath']#.decode('utf-8')
-                  if filePath.lower().endswith("hdf5"):
-                    q.put([self.startingSequenceNumber,filePath])
-                    l.debug("Putting file of seq={}, {} to the queue".format(self.startingSequenceNumber,filePath))
-      return
-
-# Process items in the queue
-def traverse(root_path):
-  l.debug("Directory: {}".format(root_path))
-  while True:
-    if q.empty():
-      time.sleep(1)
-      print("No items in a queue.")
-    else:
-      with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
-        while not q.empty():
-          try:
-            anItem=q.get()
-            sequenceNumber = anItem[0]
-            filePath = anItem[1]
-            executor.submit(processPath, sequenceNumber, filePath, root_path)
-          except KeyboardInterrupt:
-            executor.shutdown(wait=False)
-            myChangesListener.exit()
-            if fileHandlesTimer: fileHandlesTimer.cancel()
-
-# Process a single path
-def processPath(sequenceNumber, path,root_path):
-  try:
-    threadId = threading.current_thread().ident
-    if not threadId in threadIdToWorkerNumberMap:
-      threadIdToWorkerNumberMap[threadId]=len(threadIdToWorkerNumberMap)
-    #l.info("threadId={}, sequenceNumber={}, file={}".format(threadId,sequenceNumber,fileHandles[threadIdToWorkerNumberMap[threadId]]))
-    threadsSequenceNumbers[threadIdToWorkerNumberMap[threadId]]=sequenceNumber
-
-    if path.endswith('.json'):
-      wholeStart = time.time()
-      l.debug("Opening file: {}".format(path))
-      start = time.time() ; file = root_path.open(path,mode="r") ; end = time.time() ; fileOpenTime=(end - start)
-      fileName = file.name
-      filePath = file
-      l.debug("Getting size of file: {}".format(path))
-      start = time.time() ; size = odfs.getinfo(fileName).size ; end = time.time() ; filegetInfoTime=(end - start)
-      l.debug("Size of file {} is: {}".format(path,size))
-      if size > 0:
-        l.debug("Reading file: {}".format(path))
-        start = time.time() ; decoded_json = json.loads(file.read()) ; end = time.time() ; metadataExtractTime=(end - start)
-        l.debug("Attaching metadata to: {}".format(file))
-        start = time.time() ; odfs.setxattr(fileName,"onedata_json",json.dumps(decoded_json)) ; end = time.time() ; metadataSetOnedataFSTime=(end - start)
-        start = time.time() ; file.close() ; end = time.time() ; fileCloseTime=(end - start)
-        start = time.time() ; accessType=odfs.getxattr(fileName,b"org.onedata.access_type") ; end = time.time() ; getAccessTypeTime=(end - start)
-        l.debug("File={}, Access type={}, Metadata extract time={}, Metadata set with OnedataFS={}".format(filePath,accessType,metadataExtractTime,metadataSetOnedataFSTime))
-        jsonLog = {} ;
-        jsonLog["file"] = fileName ; jsonLog["metadataExtrationTime"] = metadataExtractTime ; jsonLog["accessType"] = str(accessType) ; jsonLog["metadataSettingTime"] = metadataSetOnedataFSTime ;
-        jsonLog['getAccessTypeTime'] = getAccessTypeTime ; jsonLog['filegetInfoTime'] = filegetInfoTime ; jsonLog['fileOpenTime'] = fileOpenTime ;
-        jsonLog['listDirTime'] = listDirTime ; jsonLog['isDirectoryTime'] = isDirectoryTime ; jsonLog['fileCloseTime'] = fileCloseTime ;
-        wholeEnd= time.time()
-        jsonLog['wholeTime'] = wholeEnd - wholeStart
-        l.info("jsonLog: {}".format(json.dumps(jsonLog)))
-      else:
-        start = time.time() ; file.close() ; end = time.time() ; fileCloseTime=(end - start)
-        l.debug("size zero, omitting {}".format(file))
-    else:
-      l.debug("file does not match regex, omitting {}".format(path))
-  except Exception as e:
-    print("ERRROR!")
-    l.info(e)
+  spaceId=spaceIds[0]
+print("Space name={} spaceId={}".format(sourceSpaceName,spaceId))
+if shardCount > 1:
+  l.info("Ingesting shard {} of {}".format(shardIndex,shardCount))
+
+# A change is done with when its file is processed or omitted, or the change is merged into a newer one
+def changeDone(change):
+  checkpoint.finished(change.seq)
+  if queueDir: changesQueue.ack(change)
 
 # Ensure existence of structure of persistent direstories
 statePersistencePath="./persistence/state"
+# Each shard keeps its checkpoint in a directory of its own
+globalStatePath=statePersistencePath
+if shardCount > 1:
+  statePersistencePath=shardDirectory(globalStatePath, shardIndex, shardCount)
 if not os.path.exists(statePersistencePath):
     os.makedirs(statePersistencePath)
 
-# If no starting sequence number was given try to get it from saved states
-if initialStartingSequence == None:
-  lowestSequenceNumber=None
-  for stateFilePath in os.listdir(statePersistencePath):
-    aFileHandle = open(os.path.join(statePersistencePath,stateFilePath),"r")
-    try:
-      # the file might be empty, corrupted, or content might not be a number
-      savedSequence = int(aFileHandle.read())
-    except ValueError:
-      continue
-    aFileHandle.close()
-    if lowestSequenceNumber == None:
-      lowestSequenceNumber = savedSequence
-    else:
-      if lowestSequenceNumber > savedSequence:
-        lowestSequenceNumber = savedSequence
-
-  initialStartingSequence = lowestSequenceNumber
-
-# If values is None, then there were not files to load the saved state from
-if initialStartingSequence != None:
-  firstFileHandle = open(os.path.join(statePersistencePath,"{}.seq".format(0)),"w")
-  # Save the state in case the script crashes early
-  firstFileHandle.write(str(initialStartingSequence))
-  firstFileHandle.close()
+# The committed sequence number is saved in a single checkpoint file
+checkpoint = CheckpointTracker(os.path.join(statePersistencePath,CHECKPOINT),
+                               beforeSave=changesQueue.sync if queueDir else None)
 
-# Remove all the state files except the first
+if initialStartingSequence != None:
+  # Replay from the explicitly requested sequence
+  checkpoint.reset(initialStartingSequence - 1)
+elif checkpoint.committed != None:
+  # Resume right after the last committed change
+  initialStartingSequence = checkpoint.committed + 1
+elif statePersistencePath != globalStatePath:
+  # A new shard starts from the global commit of all shards, or of the ingestion before it was split
+  globalCommitted = CheckpointTracker(os.path.join(globalStatePath,CHECKPOINT)).committed
+  if globalCommitted != None:
+    initialStartingSequence = globalCommitted + 1
+    checkpoint.reset(globalCommitted)
+else:
+  # Resume from the lowest sequence saved per worker by older versions of this script
+  for stateFilePath in os.listdir(statePersistencePath):
+    if re.match(r"^\d+\.seq$", stateFilePath):
+      with open(os.path.join(statePersistencePath,stateFilePath),"r") as aFileHandle:
+        try:
+          savedSequence = int(aFileHandle.read())
+        except ValueError:
+          continue
+      if initialStartingSequence == None or initialStartingSequence > savedSequence:
+        initialStartingSequence = savedSequence
+  if initialStartingSequence != None:
+    checkpoint.reset(initialStartingSequence - 1)
+
+# Save the state in case the script crashes early and remove per worker state files
+checkpoint.save()
 for stateFilePath in os.listdir(statePersistencePath):
-  if stateFilePath != "0.seq":
+  if re.match(r"^\d+\.seq$", stateFilePath):
     os.remove(os.path.join(statePersistencePath,stateFilePath))
+checkpoint.start()
+
+# Latency, throughput and backlog of the ingestion
+metrics = IngestionMetrics()
 
-for i in range(0,numberOfWorkers):
-  # mode 'a' was chosen, not to overwrite the value of the '0.seq'
-  fileHandles.append(open(os.path.join(statePersistencePath,"{}.seq".format(i)),"a"))
-
-def flushFileHandles():
-    for i in range(0,len(fileHandles)):
-      aSequenceNumber=threadsSequenceNumbers[i]
-      if aSequenceNumber != None:
-        fileHandles[i].truncate(0)
-        # temporary save of a sequence so the value does not change between write and when log message if printed
-        fileHandles[i].write(str(aSequenceNumber))
-        fileHandles[i].flush()
-        l.info("Saving sequence={} of worker={} to file={}, ".format(threadsSequenceNumbers[i],i,fileHandles[i]))
-    # TODO: fix it so that a task is scheduled properly!
-    fileHandlesTimer = threading.Timer(2.0, flushFileHandles)
-    fileHandlesTimer.start()
-
-fileHandlesTimer = threading.Timer(2.0, flushFileHandles)
-fileHandlesTimer.start()
+# Extractors of the ingested formats, the changes listener picks files by their names
+extractors = createRegistry(extractorNames, extractorOptions)
+
+# Files already ingested, to tell own metadata writes from real changes. With an index
+# file they are remembered between restarts, so replayed unchanged files are skipped
+indexPath = os.environ.get('INDEX_PATH')
+if indexPath and shardCount > 1:
+  indexPath = shardFile(indexPath, shardIndex, shardCount)
+ingestedFiles = FileIndex(indexPath) if indexPath else IngestedFiles()
 
 # Initialize OnedataFS
 odfs = OnedataFS(sourceProvider, apiToken, insecure=True, force_direct_io=True)
@@ -241,18 +192,59 @@ l.debug(odfs.listdir('/'))
 space = odfs.opendir('/{}'.format(sourceSpaceName))
 
 # Start filling up the queue with files
-myChangesListener = ChangesListener(name='producer',startingSequenceNumber=initialStartingSequence)
+if coalescer: coalescer.start()
+recorder = StreamRecorder(recordDir) if recordDir else None
+if replayDir:
+  myChangesListener = ReplayListener(replayDir, changesQueue, accept=shardFilter(extractors.forPath, shardIndex, shardCount),
+                                     startingSequenceNumber=initialStartingSequence, speed=replaySpeed,
+                                     checkpoint=checkpoint)
+else:
+  myChangesListener = ChangesListener(sourceProvider, spaceId, apiToken, changesQueue,
+                                      accept=shardFilter(extractors.forPath, shardIndex, shardCount),
+                                      startingSequenceNumber=initialStartingSequence,
+                                      checkpoint=checkpoint, client=client, recorder=recorder)
 myChangesListener.start()
 
-# Process items in the queue
-traverse(odfs)
+# Process items in the queue with a pipeline of stages that run all the time
+stages = IngestionStages(odfs, extractors, ingestedFiles, metrics,
+                         onDone=lambda task: changeDone(task.change), jsonLog=jsonLogEnabled)
+pipeline = Pipeline(q, [
+  stage('open', stages.openFile, 3, 16, adaptive=adaptiveConcurrency),
+  stage('extract', stages.extractMetadata, 3, 16, adaptive=adaptiveConcurrency),
+  stage('attach', stages.attachMetadata, 3, 16, adaptive=adaptiveConcurrency),
+], onDone=stages.logTask)
+pipeline.start()
+if adaptiveConcurrency:
+  AimdController(pipeline.stages, interval=float(os.environ.get('ADAPT_INTERVAL', 10)),
+                 tolerance=float(os.environ.get('ADAPT_LATENCY_TOLERANCE', 2))).start()
+
+# Expose metrics of the ingestion
+metrics.watchQueue('changes', changesQueue)
+if coalescer:
+  metrics.watchCoalescer(coalescer)
+  metrics.watchQueue('ready', q)
+metrics.watchPipeline(pipeline)
+metrics.watchStream(myChangesListener, checkpoint, sourceSpaceName)
+if metricsPort: metrics.serve(metricsPort)
+
+# Stop on SIGTERM like on Ctrl-C, so queues, checkpoints and recordings are closed
+def terminate(signum, frame):
+  raise KeyboardInterrupt
+signal.signal(signal.SIGTERM, terminate)
+
+try:
+  pipeline.join()
+except KeyboardInterrupt:
+  myChangesListener.stop()
 
 # Close OnedataFS
 l.info("Processing ended. Closing onedatafs.")
+if indexPath: ingestedFiles.close()
 odfs.close()
 
-# Close workers filehandles
-for i in range(0,numberOfWorkers):
-  fileHandles[i].close()
+# Save the last committed sequence
+checkpoint.close()
+if queueDir: changesQueue.close()
+if recorder: recorder.close()
 
 sys.exit(0)
\ No newline at end of file
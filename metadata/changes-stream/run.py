@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-import os, sys, json, time
-import threading, Queue, concurrent.futures
+import os, sys, time, signal
+import Queue
 
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -11,8 +11,23 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 # Onedatafs for data access
 from fs.onedatafs import OnedataFS
 
-# CTA Extractor
-from onedatacustom.metadataextractor import MetaDataExtractorHdf5
+# Shared ingestion building blocks
+from onedataingest.changes import ChangesListener, Change
+from onedataingest.recording import StreamRecorder, ReplayListener
+from onedataingest.rest import RestClient, SpaceCache
+from onedataingest.pipeline import Pipeline
+from onedataingest.stages import IngestionStages, stage
+from onedataingest.concurrency import AimdController
+from onedataingest.coalesce import Coalescer
+from onedataingest.spillqueue import SpillQueue
+from onedataingest.fairqueue import FairQueue, parseWeights
+from onedataingest.digests import IngestedFiles
+from onedataingest.fileindex import FileIndex
+from onedataingest.checkpoint import CheckpointTracker
+from onedataingest.sharding import shardFilter, shardDirectory, shardFile, CHECKPOINT
+from onedataingest.metrics import IngestionMetrics
+from onedataingest.extractpool import ExtractorPool
+from onedataingest.extractors import createRegistry
 
 # Configure logging
 import logging as l
@@ -20,132 +35,241 @@ l.basicConfig(level=l.INFO, format='%(message)s')
 
 # Input parameters 
 onezoneUrl=os.environ['ONEZONE_HOST']
-sourceSpaceName=os.environ['SPACE_NAME']
+# Spaces to ingest given as SPACE_NAMES=name[:weight],... (e.g. raw:3,calibrated), SPACE_NAME by default.
+# All spaces share OnedataFS, REST connections and workers. Each space has its own changes listener,
+# queue and checkpoint; while several spaces have changes waiting, workers take them by weight.
+spaceWeights=parseWeights(os.environ.get('SPACE_NAMES') or os.environ['SPACE_NAME'])
+multiSpace=len(spaceWeights) > 1
 apiToken=os.environ['ONECLIENT_ACCESS_TOKEN']
 sourceProvider=os.environ['ONECLIENT_PROVIDER_HOST']
 insecure=os.environ['ONECLIENT_INSECURE']
 lastSeq=os.environ['LAST_SEQUENCE']
+# Number of processes extracting metadata, 0 extracts in threads of the pipeline
+extractProcesses=int(os.environ.get('EXTRACT_PROCESSES', 0))
+# Files are read in blocks of this size, kept in a per file cache of READ_CACHE_BLOCKS blocks,
+# READ_AHEAD_BLOCKS following blocks are fetched together when a file is read sequentially.
+# Set READ_BLOCK_SIZE to 0 to read files directly.
+readerOptions=None
+if int(os.environ.get('READ_BLOCK_SIZE', 512 * 1024)) > 0:
+  readerOptions=dict(blockSize=int(os.environ.get('READ_BLOCK_SIZE', 512 * 1024)),
+                     readAhead=int(os.environ.get('READ_AHEAD_BLOCKS', 4)),
+                     maxBlocks=int(os.environ.get('READ_CACHE_BLOCKS', 64)))
 
-# Space id will be inferred from Onezone based on space name
-spaceId=""
-
-# Initialize a Queue for threads to communicate. 
-# During tests the queue never reached size more then 10k
-BUF_SIZE = 1000000
-q = Queue.Queue(BUF_SIZE)
-
-# Get spaceId from the space name
-with requests.Session() as session:
-  session.headers.update({'X-Auth-Token': apiToken })
-  url="{}/api/v3/onezone/user/spaces".format(onezoneUrl)
-  response = session.get(url,verify=False)
-
-  for space in response.json()['spaces']:
-    url="{}/api/v3/onezone/spaces/{}".format(onezoneUrl,space)
-    response = session.get(url,verify=False)
-    if response.json()['name'] == sourceSpaceName:
-      if spaceId=="":
-        spaceId=response.json()['spaceId']
-      else:
-        print("Error more then 1 space of name={} exists in the provider {}".format(sourceSpaceName,sourceProvider))
-        sys.exit(1)
-  if spaceId=="":
-    print("No space of name={} exists in the provider {}".format(sourceSpaceName,sourceProvider))
+# Formats of files to ingest, the CTA extractor handles hdf5 files
+extractorNames=os.environ.get('EXTRACTORS', 'hdf5,fits').split(',')
+extractorOptions={ 'fits': dict(maxHdus=int(os.environ.get('FITS_MAX_HDUS', 32))),
+                   'json': dict(maxSize=int(os.environ.get('JSON_MAX_SIZE', 16 * 1024 * 1024))) }
+
+# Number of workers of each stage adapts to the latency of the provider, within <STAGE>_MIN_WORKERS
+# and <STAGE>_MAX_WORKERS. With ADAPTIVE_CONCURRENCY=false stages keep <STAGE>_WORKERS workers.
+adaptiveConcurrency=os.environ.get('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+
+# Port of the HTTP endpoint serving metrics in Prometheus format, 0 disables it
+metricsPort=int(os.environ.get('METRICS_PORT', 0))
+# Log timings of every processed file as a jsonLog line
+jsonLogEnabled=os.environ.get('JSON_LOG', 'true').lower() == 'true'
+
+# Space id will be inferred from Onezone based on space name, unless SPACE_ID is given for a single space
+spaceId=os.environ.get('SPACE_ID', "")
+
+# With RECORD_DIR the raw changes stream is saved in compressed segment files in this directory.
+# With REPLAY_DIR changes are read from such a recording instead of the provider, starting from
+# LAST_SEQUENCE, at full speed or at REPLAY_SPEED times the recorded rate; the ingestion ends with it.
+# With several spaces each is recorded in a subdirectory named after it.
+recordDir=os.environ.get('RECORD_DIR')
+replayDir=os.environ.get('REPLAY_DIR')
+replaySpeed=float(os.environ.get('REPLAY_SPEED', 0))
+
+# With SHARD_COUNT > 1 the ingestion is split between processes, this one only ingests files
+# whose path hashes to SHARD_INDEX. Run them with: python -m onedataingest.sharding run.py
+shardCount=int(os.environ.get('SHARD_COUNT', 1))
+shardIndex=int(os.environ.get('SHARD_INDEX', 0))
+
+# Initialize a bounded Queue for threads to communicate. When it is full
+# the changes listener stops reading the stream until workers catch up.
+# Each space has a queue of QUEUE_SIZE changes.
+BUF_SIZE = int(os.environ.get('QUEUE_SIZE', 1000))
+# With QUEUE_DIR changes are queued in segment files in this directory, only
+# QUEUE_SIZE of them are kept in memory. The listener is never held back
+# and queued changes are processed after a restart. With several spaces
+# each has a subdirectory named after it.
+queueDir = os.environ.get('QUEUE_DIR')
+
+# Changes of the same file arriving within this many seconds are merged
+# into one, 0 (the default) passes every change to workers without delay
+coalesceWindow = float(os.environ.get('COALESCE_WINDOW', 0))
+
+# Workers take changes of all spaces from this queue, by weighted round robin,
+# so a burst of changes in one space does not hold back the others
+q = FairQueue(spaceWeights, maxsize=BUF_SIZE)
+
+# One pool of keep-alive connections for all REST calls of the script
+client = RestClient(onezoneUrl, apiToken)
+spaceCachePath=os.environ.get('SPACE_CACHE_PATH')
+spaceCache=SpaceCache(spaceCachePath, ttl=float(os.environ.get('SPACE_CACHE_TTL', 86400))) if spaceCachePath else None
+
+# Get spaceId from the space name, unless it is given or not needed for a replay
+def lookupSpaceId(spaceName):
+  if spaceId!="" and not multiSpace:
+    return spaceId
+  if replayDir:
+    return ""
+  spaceIds=client.spaceIds(spaceName, cache=spaceCache)
+  if len(spaceIds) > 1:
+    print("Error more then 1 space of name={} exists in the provider {}".format(spaceName,sourceProvider))
     sys.exit(1)
-  print("Space name={} spaceId={}".format(sourceSpaceName,spaceId))
-
-# Changes stream is consumed in a separate thread
-class ChangesListener(threading.Thread):
-    def __init__(self, group=None, target=None, name=None,
-                 args=(), kwargs=None, verbose=None):
-        super(ChangesListener,self).__init__()
-        self.target = target
-        self.name = name
-
-    def run(self):
-      # Start listening the changes API
-      changesJSON='{ "fileMeta": { "fields": ["name", "type", "deleted"], "always": true }}'
-      while True:
-        with requests.Session() as session:
-          session.headers.update({'X-Auth-Token': apiToken })
-          session.headers.update({'content-type': 'application/json' })
-          url="https://{}/api/v3/oneprovider/changes/metadata/{}?timeout=60000&last_seq={}".format(sourceProvider,spaceId,lastSeq)
-          response = session.post(url,data=changesJSON,verify=False,stream=True)
-
-          lines = response.iter_lines()
-          for line in lines:
-            if line:
-                decoded_line = json.loads(line.decode('utf-8'))
-                if decoded_line["fileMeta"]["changed"] and not decoded_line["fileMeta"]["deleted"]:
-                  filePath=decoded_line['filePath']#.decode('utf-8')
-                  if filePath.lower().endswith("hdf5"):
-                    q.put(filePath)
-                    l.debug("Putting file {} to the queue".format(filePath))
-      return
-
-# Process items in the queue
-def traverse(root_path):
-  l.debug("Directory: {}".format(root_path))
-  while True:
-    if q.empty():
-      time.sleep(1)
-      print("No items in a queue.")
-    else:
-      with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        while not q.empty():
-          executor.submit(processPath, q.get(), root_path)
-
-# Process a single path
-def processPath(path,root_path):
-  try:
-    if path.endswith('.hdf5'):
-      wholeStart = time.time()
-      l.debug("Opening file: {}".format(path))
-      start = time.time() ; file = root_path.openbin(path,mode="r+") ; end = time.time() ; fileOpenTime=(end - start)
-      fileName = file.path
-      filePath = path
-      l.debug("Getting size of file: {}".format(path))
-      start = time.time() ; size = odfs.getinfo(fileName).size ; end = time.time() ; filegetInfoTime=(end - start)
-      l.debug("Size of file {} is: {}".format(path,size))
-      if size > 0:
-        l.debug("Extracting metadata from file: {}".format(path))
-        start = time.time() ; decoded_json = MetaDataExtractorHdf5(file).to_json() ; end = time.time() ; metadataExtractTime=(end - start)
-        l.debug("Attaching metadata to: {}".format(path))
-        start = time.time() ; odfs.setxattr(fileName,"onedata_json",json.dumps(decoded_json)) ; end = time.time() ; metadataSetOnedataFSTime=(end - start)
-        start = time.time() ; file.close() ; end = time.time() ; fileCloseTime=(end - start)
-        start = time.time() ; accessType=odfs.getxattr(fileName,b"org.onedata.access_type") ; end = time.time() ; getAccessTypeTime=(end - start)
-        l.debug("File={}, Access type={}, Metadata extract time={}, Metadata set with OnedataFS={}".format(filePath,accessType,metadataExtractTime,metadataSetOnedataFSTime))
-        jsonLog = {} ;
-        jsonLog["file"] = fileName ; jsonLog["metadataExtrationTime"] = metadataExtractTime ; jsonLog["accessType"] = str(accessType) ; jsonLog["metadataSettingTime"] = metadataSetOnedataFSTime ;
-        jsonLog['getAccessTypeTime'] = getAccessTypeTime ; jsonLog['filegetInfoTime'] = filegetInfoTime ; jsonLog['fileOpenTime'] = fileOpenTime ;  
-        jsonLog['fileCloseTime'] = fileCloseTime ; 
-        wholeEnd= time.time()
-        jsonLog['wholeTime'] = wholeEnd - wholeStart 
-        jsonLog['queueSize'] = q.qsize()
-        l.info("jsonLog: {}".format(json.dumps(jsonLog)))
+  if not spaceIds:
+    print("No space of name={} exists in the provider {}".format(spaceName,sourceProvider))
+    sys.exit(1)
+  return spaceIds[0]
+if shardCount > 1:
+  l.info("Ingesting shard {} of {}".format(shardIndex,shardCount))
+
+# A change is done with when its file is processed or omitted, or the change is merged into a newer one
+def changeDone(change):
+  # paths start with the name of the space
+  spaces[change.filePath.split('/', 2)[1] if multiSpace else next(iter(spaceWeights))].done(change)
+
+# Start extraction processes before OnedataFS and threads, as they are forked from this one
+extractorPool = None
+if extractProcesses > 0:
+  extractorPool = ExtractorPool(extractProcesses, extractorNames, extractorOptions,
+                                (sourceProvider, apiToken), dict(insecure=True, force_direct_io=True), readerOptions)
+
+# Extractors of the ingested formats, the changes listener picks files by their names
+extractors = createRegistry(extractorNames, extractorOptions)
+
+# Latency, throughput and backlog of the ingestion
+metrics = IngestionMetrics()
+
+# Files already ingested, to tell own metadata writes from real changes. With an index
+# file they are remembered between restarts, so replayed unchanged files are skipped
+indexPath = os.environ.get('INDEX_PATH')
+if indexPath and shardCount > 1:
+  indexPath = shardFile(indexPath, shardIndex, shardCount)
+ingestedFiles = FileIndex(indexPath) if indexPath else IngestedFiles()
+
+# Queue, checkpoint and changes listener of a space
+class SpaceIngestion(object):
+    def __init__(self, name):
+      self.name = name
+      self.spaceId = lookupSpaceId(name)
+      print("Space name={} spaceId={}".format(name,self.spaceId))
+      # With several spaces or shards each keeps its queue and checkpoint in a directory of its own
+      self.stateDir = os.path.join(queueDir, name) if queueDir and multiSpace else queueDir
+      self.queueDir = self.stateDir
+      if self.stateDir and shardCount > 1:
+        self.queueDir = shardDirectory(self.stateDir, shardIndex, shardCount)
+      self.ready = q.queue(name)
+      if self.queueDir:
+        self.changesQueue = SpillQueue(self.queueDir, memoryItems=BUF_SIZE, segmentItems=int(os.environ.get('QUEUE_SEGMENT_ITEMS', 10000)),
+                                       decode=lambda values: Change(*values))
+      elif coalesceWindow > 0:
+        self.changesQueue = Queue.Queue(BUF_SIZE)
+      else:
+        self.changesQueue = self.ready
+      self.coalescer = None
+      if coalesceWindow > 0:
+        self.coalescer = Coalescer(self.changesQueue, self.ready, coalesceWindow, maxPending=int(os.environ.get('COALESCE_MAX_PENDING', 100000)),
+                                   onMerged=changeDone, name='coalescer-{}'.format(name))
+
+      # Track which changes are fully processed, to report how far behind the stream ingestion is.
+      # Along with a queue on disk the position in the stream is saved, to continue from it after a restart.
+      self.checkpoint = CheckpointTracker(os.path.join(self.queueDir, CHECKPOINT) if self.queueDir else None,
+                                          beforeSave=self.changesQueue.sync if self.queueDir else None)
+      if self.checkpoint.committed is None and self.queueDir != self.stateDir:
+        # a new shard starts from the global commit of all shards, or of the ingestion before it was split
+        globalCommitted = CheckpointTracker(os.path.join(self.stateDir, CHECKPOINT)).committed
+        if globalCommitted is not None:
+          self.checkpoint.reset(globalCommitted)
+      self.lastSeq = lastSeq
+      if self.checkpoint.committed is not None:
+        self.lastSeq = self.checkpoint.committed + 1
+        l.info("Resuming the changes stream of {} from seq={} saved in {}, {} changes queued".format(
+          name,self.lastSeq,self.queueDir,self.changesQueue.qsize()))
+      if self.queueDir: self.checkpoint.start()
+
+    # Start filling up the queue with files
+    def start(self):
+      if self.coalescer:
+        self.coalescer.start()
+      elif self.queueDir:
+        q.forward(self.name, self.changesQueue)
+      accept = shardFilter(extractors.forPath, shardIndex, shardCount)
+      spaceRecordDir = os.path.join(recordDir, self.name) if recordDir and multiSpace else recordDir
+      self.recorder = StreamRecorder(spaceRecordDir) if spaceRecordDir else None
+      if replayDir:
+        self.listener = ReplayListener(os.path.join(replayDir, self.name) if multiSpace else replayDir, self.changesQueue,
+                                       accept=accept, startingSequenceNumber=self.lastSeq, speed=replaySpeed,
+                                       checkpoint=self.checkpoint, name='replay-{}'.format(self.name))
       else:
-        start = time.time() ; file.close() ; end = time.time() ; fileCloseTime=(end - start)
-        l.debug("size zero, omitting {}".format(file))
-    else:
-      l.debug("file does not match regex, omitting {}".format(path))
-  except Exception as e:
-    l.info(e)
-
-# Initialize OnedataFS
+        self.listener = ChangesListener(sourceProvider, self.spaceId, apiToken, self.changesQueue, accept=accept,
+                                        startingSequenceNumber=self.lastSeq, checkpoint=self.checkpoint, client=client,
+                                        recorder=self.recorder, name='producer-{}'.format(self.name))
+      self.listener.start()
+
+    def done(self, change):
+      self.checkpoint.finished(change.seq)
+      if self.queueDir: self.changesQueue.ack(change)
+
+    def close(self):
+      self.checkpoint.close()
+      if self.queueDir: self.changesQueue.close()
+      if self.recorder: self.recorder.close()
+
+spaces = dict((name, SpaceIngestion(name)) for name in spaceWeights)
+
+# Initialize OnedataFS, shared by all spaces
 odfs = OnedataFS(sourceProvider, apiToken, insecure=True, force_direct_io=True)
 # Print list of user spaces 
 l.debug(odfs.listdir('/'))
-# Open the space
-space = odfs.opendir('/{}'.format(sourceSpaceName))
 
-# Start filling up the queue with files
-p = ChangesListener(name='producer')
-p.start()
+# Open the spaces and start filling up the queue with files
+for space in spaces.values():
+  odfs.opendir('/{}'.format(space.name))
+  space.start()
+
+# Process items in the queue with a pipeline of stages that run all the time
+stages = IngestionStages(odfs, extractors, ingestedFiles, metrics, extractorPool=extractorPool, readerOptions=readerOptions,
+                         onDone=lambda task: changeDone(task.change), jsonLog=jsonLogEnabled, queue=q)
+pipeline = Pipeline(q, [
+  stage('open', stages.openFile, 2, 16, adaptive=adaptiveConcurrency),
+  # more threads than processes would only wait for the pool
+  stage('extract', stages.extractMetadata, extractProcesses or 2, extractProcesses or 8, adaptive=adaptiveConcurrency),
+  stage('attach', stages.attachMetadata, 2, 16, adaptive=adaptiveConcurrency),
+], onDone=stages.logTask)
+pipeline.start()
+if adaptiveConcurrency:
+  AimdController(pipeline.stages, interval=float(os.environ.get('ADAPT_INTERVAL', 10)),
+                 tolerance=float(os.environ.get('ADAPT_LATENCY_TOLERANCE', 2))).start()
+
+# Expose metrics of the ingestion, queues of several spaces are told apart by the name of the space
+for space in spaces.values():
+  suffix = ":" + space.name if multiSpace else ""
+  metrics.watchQueue('changes' + suffix, space.changesQueue)
+  if space.coalescer:
+    metrics.watchCoalescer(space.coalescer, 'coalescing' + suffix)
+    metrics.watchQueue('ready' + suffix, space.ready)
+  metrics.watchStream(space.listener, space.checkpoint, space.name)
+metrics.watchPipeline(pipeline)
+if metricsPort: metrics.serve(metricsPort)
+
+# Stop on SIGTERM like on Ctrl-C, so queues, checkpoints and recordings are closed
+def terminate(signum, frame):
+  raise KeyboardInterrupt
+signal.signal(signal.SIGTERM, terminate)
 
-# Process items in the queue
-traverse(odfs)
+try:
+  pipeline.join()
+except KeyboardInterrupt:
+  for space in spaces.values():
+    space.listener.stop()
 
 # Close OnedataFS
 l.info("Processing ended. Closing onedatafs.")
+if indexPath: ingestedFiles.close()
+if extractorPool: extractorPool.close()
 odfs.close()
+for space in spaces.values():
+  space.close()
 sys.exit(0)
\ No newline at end of file
@@ -0,0 +1 @@
+# Building blocks shared by the metadata ingestion samples
@@ -0,0 +1,103 @@
+import io
+from collections import OrderedDict
+
+# Read-only file wrapper reading the underlying file in large aligned blocks.
+#
+# Metadata extractors seek around a file and issue many small reads, each
+# of them a separate request to the provider when direct I/O is used. Here
+# every read is served from an LRU cache of `blockSize` blocks. A missing
+# block is fetched with a single read of the underlying file, together with
+# the following `readAhead` blocks when the file is read sequentially. Only
+# the parts of the file the extractor touches are transferred, in a few
+# large requests, however big the file is.
+class CachedReader(io.RawIOBase):
+    def __init__(self, file, blockSize=512 * 1024, readAhead=4, maxBlocks=64):
+      super(CachedReader,self).__init__()
+      self.file = file
+      self.blockSize = blockSize
+      self.readAhead = readAhead
+      self.maxBlocks = max(maxBlocks, readAhead + 1)
+      self.blocks = OrderedDict()
+      self.position = 0
+      self.lastFetched = None
+      # Number and total size of reads of the underlying file
+      self.requests = 0
+      self.bytesFetched = 0
+      self.path = getattr(file, 'path', None)
+      self.name = getattr(file, 'name', self.path)
+
+    def readable(self):
+      return True
+
+    def seekable(self):
+      return True
+
+    def writable(self):
+      return False
+
+    def tell(self):
+      return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+      if whence == io.SEEK_SET:
+        position = offset
+      elif whence == io.SEEK_CUR:
+        position = self.position + offset
+      elif whence == io.SEEK_END:
+        self.file.seek(0, io.SEEK_END)
+        position = self.file.tell() + offset
+      else:
+        raise ValueError("invalid whence ({})".format(whence))
+      if position < 0:
+        raise ValueError("negative seek position {}".format(position))
+      self.position = position
+      return position
+
+    def block(self, index):
+      block = self.blocks.pop(index, None)
+      if block is None:
+        self.fetch(index)
+        block = self.blocks.pop(index)
+      self.blocks[index] = block
+      return block
+
+    # Read the block and, when reading sequentially, the ones following it in one request
+    def fetch(self, index):
+      count = 1
+      if self.lastFetched is not None and index == self.lastFetched + 1:
+        count += self.readAhead
+        while count > 1 and index + count - 1 in self.blocks:
+          count -= 1
+      self.file.seek(index * self.blockSize)
+      data = self.file.read(count * self.blockSize)
+      self.requests += 1
+      self.bytesFetched += len(data)
+      self.lastFetched = index + count - 1
+      for i in range(count):
+        self.blocks.pop(index + i, None)
+        self.blocks[index + i] = data[i * self.blockSize:(i + 1) * self.blockSize]
+      while len(self.blocks) > self.maxBlocks:
+        self.blocks.popitem(last=False)
+
+    def readinto(self, buffer):
+      view = memoryview(buffer)
+      total = 0
+      while total < len(view):
+        index, offset = divmod(self.position, self.blockSize)
+        block = self.block(index)
+        if offset >= len(block):
+          break
+        count = min(len(block) - offset, len(view) - total)
+        view[total:total + count] = block[offset:offset + count]
+        total += count
+        self.position += count
+        # a short block is the last one in the file
+        if len(block) < self.blockSize and offset + count >= len(block):
+          break
+      return total
+
+    def close(self):
+      if not self.closed:
+        self.blocks.clear()
+        self.file.close()
+      super(CachedReader,self).close()
@@ -0,0 +1,186 @@
+import re, json, time, threading
+from collections import namedtuple
+
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# Disable warnings about red https
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+# Optional faster JSON parser, used for events the raw filter cannot handle
+try:
+  import ujson as fastjson
+except ImportError:
+  try:
+    import simplejson as fastjson
+  except ImportError:
+    fastjson = json
+
+# Configure logging
+import logging as l
+
+# Fields of an event matched in raw bytes of a line of the stream. Quotes
+# inside JSON strings are escaped, so a quoted key followed by a colon is
+# never found inside a value, e.g. in a file named 'x","deleted":true'.
+SEQ = re.compile(br'"seq"\s*:\s*(\d+)')
+NOT_CHANGED = re.compile(br'"changed"\s*:\s*false')
+DELETED = re.compile(br'"deleted"\s*:\s*true')
+# only paths and ids without escaped characters, others are decoded as JSON
+FILE_PATH = re.compile(br'"filePath"\s*:\s*"([^"\\]*)"')
+FILE_ID = re.compile(br'"fileId"\s*:\s*"([^"\\]*)"')
+
+# A single file change received from the space changes stream, `kind`
+# is what the listener's accept function returned for it (e.g. the format)
+Change = namedtuple('Change', ['seq', 'fileId', 'filePath', 'kind'])
+Change.__new__.__defaults__ = (None,)
+
+# Base url of a provider given by its host, a url with a scheme is used as it is
+def providerUrl(provider):
+  if "://" in provider:
+    return provider.rstrip('/')
+  return "https://{}".format(provider)
+
+# Changes stream is consumed in a separate thread.
+#
+# One session (and thus one keep-alive connection) is used for the whole
+# lifetime of the listener. Every time the provider closes the stream (e.g.
+# after the 60s inactivity timeout) or the connection drops, the listener
+# reconnects starting right after the last sequence number it has seen, so
+# no event is replayed. Changes are put on a bounded queue - when workers
+# fall behind, put() blocks, the socket is not read any more and the
+# provider is slowed down by TCP flow control instead of us buffering
+# an unbounded number of events in memory.
+#
+# Most events are deletions, changes without effect or files of other
+# formats. They are rejected by looking at raw bytes of the line, only
+# lines with escaped characters in the path are decoded as JSON. Only
+# the name (to notice new and renamed files) and the deleted flag of
+# files are observed, to keep the events small.
+class ChangesListener(threading.Thread):
+    def __init__(self, provider, spaceId, apiToken, queue, accept=None,
+                 startingSequenceNumber=None, fields=("name", "deleted"),
+                 timeout=60000, checkpoint=None, client=None, reportInterval=60, recorder=None, name='producer'):
+      super(ChangesListener,self).__init__(name=name)
+      self.daemon = True
+      self.provider = provider
+      self.spaceId = spaceId
+      self.queue = queue
+      self.accept = accept
+      self.timeout = timeout
+      # Optional CheckpointTracker told about every change read and queued
+      self.checkpoint = checkpoint
+      # Value of last_seq used for the next (re)connection, the provider
+      # streams changes starting from this sequence number (inclusive)
+      self.startingSequenceNumber = startingSequenceNumber
+      # Sequence number of the newest event received from the stream
+      self.lastSequenceNumber = None
+      self.response = None
+      # Number of events read and put to the queue, reported every reportInterval seconds
+      self.eventsRead = 0
+      self.eventsAccepted = 0
+      self.reportInterval = reportInterval
+      self.reported = (time.time(), 0, 0)
+      # Optional StreamRecorder saving every line of the stream
+      self.recorder = recorder
+      self.changesJSON = json.dumps({ "fileMeta": { "fields": list(fields), "always": True }})
+      # Connections of a RestClient shared with the rest of the script are reused
+      self.client = client
+      if client is not None:
+        self.session = client.session
+      else:
+        self.session = requests.Session()
+        self.session.headers.update({'X-Auth-Token': apiToken })
+      self.stopped = threading.Event()
+
+    def url(self):
+      url = "{}/api/v3/oneprovider/changes/metadata/{}?timeout={}".format(providerUrl(self.provider),self.spaceId,self.timeout)
+      # Supply extra argument in the url if events should start from a designated sequence
+      if self.startingSequenceNumber is not None:
+        url += "&last_seq={}".format(self.startingSequenceNumber)
+      return url
+
+    def stop(self):
+      self.stopped.set()
+      if self.client is None:
+        self.session.close()
+      elif self.response is not None:
+        self.response.close()
+
+    def run(self):
+      backoff = 1
+      while not self.stopped.is_set():
+        try:
+          l.debug("Connecting to the changes stream from seq={}".format(self.startingSequenceNumber))
+          response = self.session.post(self.url(),data=self.changesJSON,verify=False,stream=True,
+                                       headers={'content-type': 'application/json'})
+          self.response = response
+          response.raise_for_status()
+          for line in response.iter_lines():
+            if line:
+              if self.recorder:
+                self.recorder.record(line)
+              self.receive(line)
+              backoff = 1
+          response.close()
+        except (requests.exceptions.RequestException, ValueError) as e:
+          if self.stopped.is_set():
+            break
+          l.info("Changes stream interrupted ({}), reconnecting from seq={} in {}s".format(e,self.startingSequenceNumber,backoff))
+          self.stopped.wait(backoff)
+          backoff = min(backoff * 2, 30)
+      return
+
+    # Consume an event, an event which can not be consumed is logged and skipped, so it does not end the listener
+    def receive(self, line):
+      try:
+        self.consume(line)
+      except Exception as e:
+        l.info("Skipping event after seq={} which could not be consumed ({}): {}".format(
+          self.lastSequenceNumber,e,line[:200].decode('utf-8', 'replace')))
+
+    def consume(self, line):
+      seq, fileId, filePath = self.filter(line)
+      self.eventsRead += 1
+      self.lastSequenceNumber = seq
+      # Resume right after this event in case the stream is reopened
+      self.startingSequenceNumber = self.lastSequenceNumber + 1
+      if filePath is not None:
+        kind = self.accept(filePath) if self.accept else True
+        if kind:
+          # mark the change in flight before it counts as seen, so it is never committed too early,
+          # unless the queue keeps it on disk until it is processed
+          if self.checkpoint and not getattr(self.queue, 'durable', False):
+            self.checkpoint.started(self.lastSequenceNumber)
+          self.queue.put(Change(self.lastSequenceNumber, fileId, filePath, None if kind is True else kind))
+          self.eventsAccepted += 1
+          l.debug("Putting file of seq={}, {} to the queue".format(self.lastSequenceNumber,filePath))
+      if self.checkpoint:
+        self.checkpoint.seen(self.lastSequenceNumber)
+      if self.reportInterval and time.time() - self.reported[0] >= self.reportInterval:
+        self.report()
+
+    # Sequence number, file id and path of a changed file, the path is None when the event is not about one
+    def filter(self, line):
+      seq = SEQ.search(line)
+      if seq is not None:
+        if NOT_CHANGED.search(line) or DELETED.search(line):
+          return int(seq.group(1)), None, None
+        filePath = FILE_PATH.search(line)
+        if filePath is not None:
+          fileId = FILE_ID.search(line)
+          return int(seq.group(1)), fileId.group(1).decode('utf-8') if fileId else None, filePath.group(1).decode('utf-8')
+      decoded_line = fastjson.loads(line.decode('utf-8'))
+      seq = decoded_line.get("seq")
+      if seq is None:
+        raise ValueError("event without a sequence number")
+      fileMeta = decoded_line.get("fileMeta") or {}
+      # like the raw filter, a file is changed unless told otherwise, and one with its deleted field set is deleted as well
+      if fileMeta.get("changed", True) and not fileMeta.get("deleted") and not (fileMeta.get("fields") or {}).get("deleted"):
+        return int(seq), decoded_line.get('fileId'), decoded_line.get('filePath')
+      return int(seq), None, None
+
+    def report(self):
+      now, read, accepted = time.time(), self.eventsRead, self.eventsAccepted
+      elapsed = max(now - self.reported[0], 1e-6)
+      l.info("Changes stream: {:.1f} events/s read, {:.1f} events/s accepted, seq={}".format(
+        (read - self.reported[1]) / elapsed, (accepted - self.reported[2]) / elapsed, self.lastSequenceNumber))
+      self.reported = (now, read, accepted)
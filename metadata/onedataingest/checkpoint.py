@@ -0,0 +1,110 @@
+import os, heapq, threading
+
+# Configure logging
+import logging as l
+
+# Tracks which sequence numbers of the changes stream are fully processed.
+#
+# Every change handed over to workers is `started` and later `finished`,
+# possibly in a different order. The committed sequence number is the
+# highest one below which nothing is in flight any more, i.e. the one
+# preceding the oldest in-flight change, or the newest `seen` one when
+# nothing is in flight. After a restart the stream can be resumed right
+# after it, without skipping a file or replaying more than necessary.
+# The committed value is saved periodically with a single atomic
+# write-temp-then-rename, so a crash never leaves a broken checkpoint.
+# Without a path the committed value is only tracked in memory.
+#
+# `beforeSave` is called before a value is saved, e.g. to sync to disk
+# a durable queue holding changes which are not in flight yet.
+class CheckpointTracker(object):
+    def __init__(self, path, flushInterval=2.0, beforeSave=None):
+      self.path = path
+      self.flushInterval = flushInterval
+      self.beforeSave = beforeSave
+      self.lock = threading.Lock()
+      self.inFlight = {}
+      self.heap = []
+      self.newest = None
+      self.committed = self.load()
+      self.saved = self.committed
+      self.stopped = threading.Event()
+
+    def load(self):
+      if self.path is None:
+        return None
+      try:
+        with open(self.path) as f:
+          return int(f.read())
+      except (IOError, OSError, ValueError):
+        # the file might not exist, be empty or its content might not be a number
+        return None
+
+    # Start tracking from the given sequence number, e.g. when requested explicitly
+    def reset(self, seq):
+      with self.lock:
+        self.inFlight, self.heap = {}, []
+        self.newest = self.committed = seq
+
+    def seen(self, seq):
+      with self.lock:
+        if self.newest is None or seq > self.newest:
+          self.newest = seq
+
+    def started(self, seq):
+      with self.lock:
+        if seq not in self.inFlight:
+          heapq.heappush(self.heap, seq)
+        self.inFlight[seq] = self.inFlight.get(seq, 0) + 1
+
+    def finished(self, seq):
+      with self.lock:
+        count = self.inFlight.get(seq, 0) - 1
+        if count > 0:
+          self.inFlight[seq] = count
+        else:
+          self.inFlight.pop(seq, None)
+        # drop finished sequence numbers from the top of the heap
+        while self.heap and self.heap[0] not in self.inFlight:
+          heapq.heappop(self.heap)
+
+    def value(self):
+      with self.lock:
+        if self.heap:
+          candidate = self.heap[0] - 1
+        else:
+          candidate = self.newest
+        if candidate is not None and (self.committed is None or candidate > self.committed):
+          self.committed = candidate
+        return self.committed
+
+    def save(self):
+      committed = self.value()
+      if self.path is None or committed is None or committed == self.saved:
+        return
+      if self.beforeSave:
+        self.beforeSave()
+      temporaryPath = self.path + ".tmp"
+      with open(temporaryPath, "w") as f:
+        f.write(str(committed))
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(temporaryPath, self.path)
+      self.saved = committed
+      l.debug("Saved checkpoint seq={} to {}".format(committed,self.path))
+
+    def saveLoop(self):
+      while not self.stopped.wait(self.flushInterval):
+        try:
+          self.save()
+        except (IOError, OSError) as e:
+          l.info("Saving checkpoint to {} failed: {}".format(self.path,e))
+
+    def start(self):
+      self.saver = threading.Thread(target=self.saveLoop, name='checkpoint')
+      self.saver.daemon = True
+      self.saver.start()
+
+    def close(self):
+      self.stopped.set()
+      self.save()
@@ -0,0 +1,68 @@
+import time, threading
+from collections import OrderedDict
+try:
+  import Queue
+except ImportError:
+  import queue as Queue
+
+# Configure logging
+import logging as l
+
+# Merges repeated changes of the same file.
+#
+# A change is held back until no other change of the same file arrives for
+# `window` seconds, then only the newest one (with the latest seq) is passed
+# to the output queue. Pending changes are kept in an ordered dict keyed by
+# file path - a repeated change is moved to the end, so the dict stays
+# ordered by deadline and both merging and dispatching are O(1). When more
+# than `maxPending` files wait, the oldest ones are dispatched early.
+class Coalescer(threading.Thread):
+    def __init__(self, source, output, window, maxPending=100000, onMerged=None, name='coalescer'):
+      super(Coalescer,self).__init__(name=name)
+      self.daemon = True
+      self.source = source
+      self.output = output
+      self.window = window
+      self.maxPending = maxPending
+      # Called with each change superseded by a newer change of the same file
+      self.onMerged = onMerged
+      self.pending = OrderedDict()
+      self.received = 0
+      self.merged = 0
+
+    def run(self):
+      while True:
+        timeout = None
+        if self.pending:
+          timeout = max(0, self.pending[next(iter(self.pending))][1] - time.time())
+        try:
+          change = self.source.get(timeout=timeout)
+        except Queue.Empty:
+          change = False
+        if change is None:
+          # End of the input - flush everything
+          while self.pending:
+            self.dispatch()
+          self.output.put(None)
+          return
+        if change:
+          self.add(change)
+        now = time.time()
+        while self.pending and self.pending[next(iter(self.pending))][1] <= now:
+          self.dispatch()
+
+    def add(self, change):
+      self.received += 1
+      previous = self.pending.pop(change.filePath, None)
+      if previous is not None:
+        self.merged += 1
+        l.debug("Merging change seq={} of {} into seq={}".format(previous[0].seq,change.filePath,change.seq))
+        if self.onMerged:
+          self.onMerged(previous[0])
+      self.pending[change.filePath] = (change, time.time() + self.window)
+      if len(self.pending) > self.maxPending:
+        self.dispatch()
+
+    def dispatch(self):
+      path, (change, deadline) = self.pending.popitem(last=False)
+      self.output.put(change)
@@ -0,0 +1,65 @@
+import threading
+
+# Configure logging
+import logging as l
+
+# Adapts the number of concurrently working threads of pipeline stages.
+#
+# Every `interval` seconds the mean latency and the error rate of each
+# stage function are looked at (additive increase, multiplicative decrease):
+# * more than `maxErrorRate` of calls failed or the latency grew above
+#   `tolerance` times the baseline - the provider is overloaded, the stage
+#   gets `decrease` times fewer workers,
+# * otherwise, if tasks had to wait for a free worker, one worker is added.
+# The baseline is the lowest latency seen, slowly following the latency up,
+# so a provider which got permanently slower is not taken as overloaded
+# forever. Limits stay within minWorkers and maxWorkers of each stage.
+class AimdController(threading.Thread):
+    def __init__(self, stages, interval=10, tolerance=2.0, maxErrorRate=0.05, decrease=0.5, drift=0.05,
+                 name='concurrency'):
+      super(AimdController,self).__init__(name=name)
+      self.daemon = True
+      self.stages = [stage for stage in stages if stage.minWorkers < stage.maxWorkers]
+      self.interval = interval
+      self.tolerance = tolerance
+      self.maxErrorRate = maxErrorRate
+      self.decrease = decrease
+      self.drift = drift
+      self.baselines = {}
+      self.stopped = threading.Event()
+
+    def stop(self):
+      self.stopped.set()
+
+    def run(self):
+      while not self.stopped.wait(self.interval):
+        for stage in self.stages:
+          try:
+            self.adjust(stage)
+          except Exception as e:
+            l.info("Adjusting workers of stage {} failed: {}".format(stage.name, e))
+
+    def adjust(self, stage):
+      calls, errors, busyTime, contended = stage.collect()
+      if calls == 0:
+        return
+      latency = busyTime / calls
+      baseline = self.baselines.get(stage.name, latency)
+      limit = stage.workers
+      if errors > calls * self.maxErrorRate:
+        reason = "{} of {} calls failed".format(errors, calls)
+        workers = stage.resize(int(limit * self.decrease))
+      elif latency > baseline * self.tolerance:
+        reason = "latency {:.3f}s above {:.3f}s baseline".format(latency, baseline)
+        workers = stage.resize(int(limit * self.decrease))
+      elif contended:
+        reason = "latency {:.3f}s, tasks waiting".format(latency)
+        workers = stage.resize(limit + 1)
+      else:
+        workers = limit
+      if workers != limit:
+        l.info("Stage {} workers {} -> {}: {}".format(stage.name, limit, workers, reason))
+      if latency < baseline:
+        self.baselines[stage.name] = latency
+      else:
+        self.baselines[stage.name] = baseline + (latency - baseline) * self.drift
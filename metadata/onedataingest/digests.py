@@ -0,0 +1,58 @@
+import json, hashlib, threading
+from collections import OrderedDict
+
+# Content hash of metadata, independent of the order of keys
+def metadataDigest(metadata):
+  return hashlib.sha1(json.dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+
+# What identifies a version of file content - its size and modification time.
+# Without a modification time a rewrite of the same size can not be told
+# apart, such a signature is never current.
+def fileSignature(info):
+  return (info.size, info.get('details', 'modified'))
+
+# Remembers files whose metadata was attached by this ingester.
+#
+# Attaching metadata is itself reported as a change of the file. Knowing the
+# signature of the file content and the digest of the metadata written last
+# time, such changes are recognized - the file is not extracted again and
+# the same metadata is not written again, which would create yet another
+# change. The most recently ingested `maxEntries` files are remembered.
+class IngestedFiles(object):
+    def __init__(self, maxEntries=100000):
+      self.maxEntries = maxEntries
+      self.files = OrderedDict()
+      self.lock = threading.Lock()
+
+    def get(self, path):
+      with self.lock:
+        record = self.files.pop(path, None)
+        if record is not None:
+          self.files[path] = record
+        return record
+
+    # Was the file ingested with exactly this content
+    def isCurrent(self, path, signature):
+      if signature[1] is None:
+        return False
+      record = self.get(path)
+      return record is not None and record['signature'] == signature
+
+    # Was exactly this metadata attached to the file
+    def isStored(self, path, digest):
+      record = self.get(path)
+      return record is not None and record['digest'] == digest
+
+    def remember(self, path, signature, digest, seq=None):
+      with self.lock:
+        self.files.pop(path, None)
+        self.files[path] = { 'signature': signature, 'digest': digest, 'seq': seq }
+        while len(self.files) > self.maxEntries:
+          self.files.popitem(last=False)
+
+# Digest of metadata currently attached to a file, None if there is none
+def storedDigest(fs, path):
+  try:
+    return metadataDigest(json.loads(fs.getxattr(path, "onedata_json")))
+  except Exception:
+    return None
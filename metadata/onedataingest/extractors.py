@@ -0,0 +1,222 @@
+import json, importlib
+
+# Bytes read from the start of a file to recognize its format by magic bytes
+HEADER_SIZE = 2056
+
+# Extracts metadata of one file format.
+#
+# A format is recognized by the suffix of the file name, which is all the
+# changes listener knows about a file, and confirmed by magic bytes of its
+# header once the file is opened. Extractors read only what they need, so
+# the cost of ingesting a file does not grow with its size.
+class Extractor(object):
+    name = None
+    suffixes = ()
+    # (offset, bytes) pairs, any of them identifies the format
+    magic = ()
+
+    def __init__(self, **options):
+      pass
+
+    def sniff(self, header):
+      if not self.magic:
+        return True
+      return any(header[offset:offset + len(value)] == value for offset, value in self.magic)
+
+    # Return metadata of an opened binary file of `size` bytes as a dict
+    def extract(self, file, size=None):
+      raise NotImplementedError()
+
+# HDF5 files, metadata is extracted by the CTA extractor
+class Hdf5Extractor(Extractor):
+    name = 'hdf5'
+    suffixes = ('.hdf5', '.h5')
+    # The superblock is at 0 or, after a user block, at 512, 1024, 2048...
+    magic = tuple((offset, b'\x89HDF\r\n\x1a\n') for offset in (0, 512, 1024, 2048))
+
+    def __init__(self, extractor="onedatacustom.metadataextractor:MetaDataExtractorHdf5", **options):
+      # Import the extractor (and h5py with it) once, not per file
+      moduleName, className = extractor.split(':')
+      self.extractorClass = getattr(importlib.import_module(moduleName), className)
+
+    def extract(self, file, size=None):
+      return self.extractorClass(file).to_json()
+
+# FITS files, including tile compressed .fits.fz, described by their headers.
+#
+# Only the 2880 bytes header blocks of each HDU are read. The size of the
+# data following a header is computed from BITPIX, NAXISn, PCOUNT and
+# GCOUNT and skipped with a seek, so data is never transferred.
+class FitsExtractor(Extractor):
+    name = 'fits'
+    suffixes = ('.fits', '.fit', '.fts', '.fits.fz', '.fz')
+    magic = ((0, b'SIMPLE  ='),)
+    BLOCK_SIZE = 2880
+    CARD_SIZE = 80
+
+    def __init__(self, maxHdus=32, **options):
+      self.maxHdus = maxHdus
+
+    def extract(self, file, size=None):
+      hdus = []
+      position = 0
+      while len(hdus) < self.maxHdus and (size is None or position < size):
+        file.seek(position)
+        header, headerSize = self.readHeader(file)
+        if header is None or (hdus and 'XTENSION' not in header):
+          break
+        hdus.append(header)
+        position += headerSize + self.paddedSize(self.dataSize(header))
+      return { "hdus": hdus }
+
+    # Parse header blocks until the END card, None at the end of the file
+    def readHeader(self, file):
+      header = {}
+      headerSize = 0
+      # keyword of the last string value, which CONTINUE cards extend
+      continued = None
+      while True:
+        block = file.read(self.BLOCK_SIZE)
+        if len(block) < self.BLOCK_SIZE:
+          if headerSize == 0:
+            return None, 0
+          raise ValueError("truncated FITS header at {} bytes".format(headerSize + len(block)))
+        headerSize += self.BLOCK_SIZE
+        for offset in range(0, self.BLOCK_SIZE, self.CARD_SIZE):
+          card = block[offset:offset + self.CARD_SIZE].decode('ascii', 'replace')
+          keyword = card[:8].strip()
+          if keyword == 'END':
+            return header, headerSize
+          if keyword in ('COMMENT', 'HISTORY'):
+            header.setdefault(keyword, []).append(card[8:].strip())
+          elif keyword == 'CONTINUE':
+            value = self.parseValue(card[8:])
+            if continued and header[continued].endswith('&') and value is not None:
+              header[continued] = header[continued][:-1] + value
+          elif keyword == 'HIERARCH' and '=' in card:
+            keyword, value = card[9:].split('=', 1)
+            header[keyword.strip()] = self.parseValue(value)
+          elif keyword and card[8:10] == '= ':
+            header[keyword] = self.parseValue(card[10:])
+            continued = keyword if self.isString(header[keyword]) else None
+
+    def isString(self, value):
+      return hasattr(value, 'endswith')
+
+    def parseValue(self, text):
+      text = text.strip()
+      if text.startswith("'"):
+        # quotes inside a string are doubled
+        characters = []
+        i = 1
+        while i < len(text):
+          if text[i] == "'":
+            if text[i + 1:i + 2] != "'":
+              break
+            i += 1
+          characters.append(text[i])
+          i += 1
+        return ''.join(characters).rstrip()
+      value = text.split('/', 1)[0].strip()
+      if value == 'T':
+        return True
+      if value == 'F':
+        return False
+      if not value:
+        return None
+      try:
+        return int(value)
+      except ValueError:
+        pass
+      try:
+        return float(value.replace('D', 'E'))
+      except ValueError:
+        return value
+
+    def dataSize(self, header):
+      axes = header.get('NAXIS') or 0
+      if axes == 0:
+        return 0
+      sizes = [header.get('NAXIS{}'.format(i)) or 0 for i in range(1, axes + 1)]
+      # random groups have no data in the first axis
+      if header.get('GROUPS') and sizes[0] == 0:
+        sizes = sizes[1:]
+      elements = 1
+      for size in sizes:
+        elements *= size
+      return abs(header.get('BITPIX') or 8) // 8 * (header.get('GCOUNT') or 1) * ((header.get('PCOUNT') or 0) + elements)
+
+    def paddedSize(self, size):
+      return (size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE * self.BLOCK_SIZE
+
+# JSON files, the whole document becomes metadata of the file.
+#
+# The file is read in chunks and given up as soon as it turns out to be
+# larger than `maxSize`, so a huge file does not exhaust memory.
+class JsonExtractor(Extractor):
+    name = 'json'
+    suffixes = ('.json',)
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, maxSize=16 * 1024 * 1024, **options):
+      self.maxSize = maxSize
+
+    def extract(self, file, size=None):
+      if size is not None and size > self.maxSize:
+        raise ValueError("JSON file of {} bytes is larger than {} bytes".format(size, self.maxSize))
+      chunks = []
+      total = 0
+      while True:
+        chunk = file.read(self.CHUNK_SIZE)
+        if not chunk:
+          break
+        total += len(chunk)
+        if total > self.maxSize:
+          raise ValueError("JSON file is larger than {} bytes".format(self.maxSize))
+        chunks.append(chunk)
+      return json.loads(b''.join(chunks).decode('utf-8'))
+
+EXTRACTORS = dict((extractor.name, extractor) for extractor in (Hdf5Extractor, FitsExtractor, JsonExtractor))
+
+# Extractors of the enabled formats, looked up by file name or content
+class ExtractorRegistry(object):
+    def __init__(self, extractors):
+      self.extractors = list(extractors)
+      self.byName = dict((extractor.name, extractor) for extractor in self.extractors)
+      # the longest suffix wins, so .fits.fz is not taken for something else ending with .fz
+      self.suffixes = sorted(((suffix.lower(), extractor.name) for extractor in self.extractors for suffix in extractor.suffixes),
+                             key=lambda item: -len(item[0]))
+
+    # Name of the extractor for a file name, None if no enabled format has its suffix
+    def forPath(self, path):
+      path = path.lower()
+      for suffix, name in self.suffixes:
+        if path.endswith(suffix):
+          return name
+      return None
+
+    # Extractor for an opened file, the one of `name` if the header matches its magic
+    # bytes, otherwise any other one with matching magic bytes, None if there is none
+    def identify(self, file, name=None):
+      header = file.read(HEADER_SIZE)
+      file.seek(0)
+      candidate = self.byName.get(name)
+      if candidate is not None and candidate.sniff(header):
+        return candidate
+      for extractor in self.extractors:
+        if extractor.magic and extractor is not candidate and extractor.sniff(header):
+          return extractor
+      return None
+
+# Registry of the named formats, `options` maps a format name to arguments of its extractor
+def createRegistry(names, options=None):
+  options = options or {}
+  extractors = []
+  for name in names:
+    name = name.strip().lower()
+    if not name:
+      continue
+    if name not in EXTRACTORS:
+      raise ValueError("unknown extractor {}, available are {}".format(name, ", ".join(sorted(EXTRACTORS))))
+    extractors.append(EXTRACTORS[name](**options.get(name, {})))
+  return ExtractorRegistry(extractors)
@@ -0,0 +1,53 @@
+import signal, multiprocessing
+
+from onedataingest.blockcache import CachedReader
+from onedataingest.extractors import createRegistry
+
+# State of a single pool process, set up once by initWorker
+worker = {}
+
+def initWorker(extractors, extractorOptions, fsArgs, fsKwargs, readerOptions):
+  # Ctrl+C is handled by the parent process
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  # Import extractors (and h5py with them) once per process, not per file
+  worker['registry'] = createRegistry(extractors, extractorOptions)
+  # Each process talks to the provider with its own OnedataFS instance
+  from fs.onedatafs import OnedataFS
+  worker['fs'] = OnedataFS(*fsArgs, **fsKwargs)
+  worker['readerOptions'] = readerOptions
+
+def extract(path, kind, size):
+  file = worker['fs'].openbin(path, mode="r")
+  if worker['readerOptions'] is not None:
+    file = CachedReader(file, **worker['readerOptions'])
+  try:
+    extractor = worker['registry'].identify(file, kind)
+    if extractor is None:
+      return None
+    return extractor.extract(file, size)
+  finally:
+    file.close()
+
+# Pool of warm processes extracting metadata outside of the GIL.
+#
+# Only the file path is sent to a worker, which opens the file with its
+# own OnedataFS and sends back the metadata dict, so file content never
+# travels between processes. Workers extract formats named in `extractors`
+# (see onedataingest.extractors) and return None for a file of any other
+# format. With `readerOptions` the file is read through a CachedReader
+# created with them. The pool has to be created before OnedataFS is
+# initialized and any thread is started in the parent process, as the
+# workers are forked from it.
+class ExtractorPool(object):
+    def __init__(self, processes, extractors, extractorOptions=None, fsArgs=(), fsKwargs=None, readerOptions=None):
+      self.processes = processes
+      self.pool = multiprocessing.Pool(processes, initWorker, (extractors, extractorOptions, fsArgs, fsKwargs or {}, readerOptions))
+
+    # Blocks the calling thread until the metadata of the file is extracted,
+    # `kind` is the name of the extractor expected for the file
+    def extract(self, path, kind=None, size=None):
+      return self.pool.apply(extract, (path, kind, size))
+
+    def close(self):
+      self.pool.close()
+      self.pool.join()
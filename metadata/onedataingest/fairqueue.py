@@ -0,0 +1,131 @@
+import time, threading
+from collections import OrderedDict, deque
+try:
+  import Queue
+except ImportError:
+  import queue as Queue
+
+# Weights given as name[:weight],..., e.g. a:3,b - weights default to 1
+def parseWeights(value):
+  weights = OrderedDict()
+  for part in value.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    name, weight = part, 1
+    if ':' in part:
+      name, weight = part.rsplit(':', 1)
+    weight = float(weight)
+    if weight <= 0:
+      raise ValueError("Weight of {} must be positive, not {}".format(name, weight))
+    weights[name] = weight
+  return weights
+
+# Queue of changes of several spaces, taken from them by weighted deficit round robin.
+#
+# Every space has a queue of its own, bounded by `maxsize` changes, so a
+# burst of changes in one space only holds back the listener of that space.
+# Spaces with changes waiting take turns in a round, in a turn a space gets
+# `weight` more changes of credit and its changes are taken while it has
+# credit left for a whole one. Over time every waiting space gets a share
+# of the changes taken proportional to its weight, whatever the backlog of
+# the others; a space with nothing waiting loses its credit, so it can not
+# save it up for a burst later. Putting None to the queue of a space ends
+# it, get returns None once all spaces ended and nothing waits.
+class FairQueue(object):
+    def __init__(self, weights, maxsize=0):
+      self.weights = OrderedDict(weights)
+      self.maxsize = maxsize
+      self.queues = OrderedDict((name, deque()) for name in self.weights)
+      self.deficits = dict.fromkeys(self.weights, 0)
+      # spaces with changes waiting, in the order of their turns
+      self.active = deque()
+      self.ended = set()
+      self.taken = dict.fromkeys(self.weights, 0)
+      self.lock = threading.Lock()
+      self.notEmpty = threading.Condition(self.lock)
+      self.notFull = threading.Condition(self.lock)
+
+    # Queue with the interface of Queue.Queue putting changes of one space
+    def queue(self, name):
+      return SpaceQueue(self, name)
+
+    def put(self, name, item, block=True, timeout=None):
+      with self.notFull:
+        if item is None:
+          self.ended.add(name)
+          self.notEmpty.notify_all()
+          return
+        queue = self.queues[name]
+        if self.maxsize > 0:
+          deadline = None if timeout is None else time.time() + timeout
+          while len(queue) >= self.maxsize:
+            remaining = None if deadline is None else deadline - time.time()
+            if not block or (remaining is not None and remaining <= 0):
+              raise Queue.Full
+            self.notFull.wait(remaining)
+        queue.append(item)
+        if len(queue) == 1:
+          self.active.append(name)
+        self.notEmpty.notify()
+
+    def get(self, block=True, timeout=None):
+      with self.notEmpty:
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.active:
+          if len(self.ended) == len(self.queues):
+            return None
+          remaining = None if deadline is None else deadline - time.time()
+          if not block or (remaining is not None and remaining <= 0):
+            raise Queue.Empty
+          self.notEmpty.wait(remaining)
+        while True:
+          name = self.active[0]
+          if self.deficits[name] >= 1:
+            break
+          # a new turn of the space
+          self.deficits[name] += self.weights[name]
+          if self.deficits[name] < 1:
+            self.active.rotate(-1)
+        queue = self.queues[name]
+        item = queue.popleft()
+        self.deficits[name] -= 1
+        self.taken[name] += 1
+        if not queue:
+          self.active.popleft()
+          self.deficits[name] = 0
+        elif self.deficits[name] < 1:
+          self.active.rotate(-1)
+        self.notFull.notify_all()
+        return item
+
+    def qsize(self, name=None):
+      with self.lock:
+        if name is not None:
+          return len(self.queues[name])
+        return sum(len(queue) for queue in self.queues.values())
+
+    # Move changes of a space from another queue, e.g. one on disk, until it ends
+    def forward(self, name, source):
+      def run():
+        while True:
+          item = source.get()
+          self.put(name, item)
+          if item is None:
+            return
+      thread = threading.Thread(target=run, name='forward-{}'.format(name))
+      thread.daemon = True
+      thread.start()
+      return thread
+
+# Changes of one space of a FairQueue
+class SpaceQueue(object):
+    def __init__(self, fairQueue, name):
+      self.fairQueue = fairQueue
+      self.name = name
+
+    def put(self, item, block=True, timeout=None):
+      self.fairQueue.put(self.name, item, block, timeout)
+
+    def qsize(self):
+      return self.fairQueue.qsize(self.name)
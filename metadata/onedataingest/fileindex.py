@@ -0,0 +1,86 @@
+import os, sqlite3, threading
+
+# Configure logging
+import logging as l
+
+from onedataingest.digests import IngestedFiles
+
+# Record of a file that is not in the index
+MISSING = { 'signature': None, 'digest': None, 'seq': None }
+
+# Persistent index of ingested files kept in a local SQLite database.
+#
+# It has the same interface as IngestedFiles, so after a restart or when
+# the stream is replayed, files that did not change since their ingestion
+# are skipped without being opened. Looked up records (including files
+# not found in the index) are cached in memory, so repeated lookups of the
+# same file do not reach the database. Writes are collected and committed
+# in batches by a background thread, every `flushInterval` seconds or as
+# soon as `batchSize` records are waiting.
+class FileIndex(IngestedFiles):
+    def __init__(self, path, batchSize=500, flushInterval=2.0, maxEntries=100000):
+      super(FileIndex,self).__init__(maxEntries)
+      directory = os.path.dirname(path)
+      if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+      self.db = sqlite3.connect(path, check_same_thread=False)
+      self.db.execute("PRAGMA journal_mode=WAL")
+      self.db.execute("PRAGMA synchronous=NORMAL")
+      self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, seq INTEGER, digest TEXT)")
+      self.db.commit()
+      self.dbLock = threading.Lock()
+      self.batchSize = batchSize
+      self.flushInterval = flushInterval
+      self.pending = {}
+      self.wakeup = threading.Event()
+      self.flusher = threading.Thread(target=self.flushLoop, name='index-flusher')
+      self.flusher.daemon = True
+      self.flusher.start()
+
+    def get(self, path):
+      record = super(FileIndex,self).get(path)
+      if record is None:
+        with self.lock:
+          waiting = self.pending.get(path)
+        if waiting is not None:
+          return { 'signature': (waiting[1], waiting[2]), 'digest': waiting[4], 'seq': waiting[3] }
+        with self.dbLock:
+          row = self.db.execute("SELECT size, mtime, seq, digest FROM files WHERE path = ?", (path,)).fetchone()
+        record = MISSING
+        if row is not None:
+          record = { 'signature': (row[0], row[1]), 'digest': row[3], 'seq': row[2] }
+        with self.lock:
+          self.files[path] = record
+          while len(self.files) > self.maxEntries:
+            self.files.popitem(last=False)
+      return record
+
+    def remember(self, path, signature, digest, seq=None):
+      super(FileIndex,self).remember(path, signature, digest, seq)
+      with self.lock:
+        self.pending[path] = (path, signature[0], signature[1], seq, digest)
+        if len(self.pending) >= self.batchSize:
+          self.wakeup.set()
+
+    def flush(self):
+      with self.lock:
+        batch, self.pending = list(self.pending.values()), {}
+      if batch:
+        with self.dbLock:
+          self.db.executemany("INSERT OR REPLACE INTO files (path, size, mtime, seq, digest) VALUES (?, ?, ?, ?, ?)", batch)
+          self.db.commit()
+        l.debug("Saved {} records to the file index".format(len(batch)))
+
+    def flushLoop(self):
+      while True:
+        self.wakeup.wait(self.flushInterval)
+        self.wakeup.clear()
+        try:
+          self.flush()
+        except sqlite3.Error as e:
+          l.info("Saving the file index failed: {}".format(e))
+
+    def close(self):
+      self.flush()
+      with self.dbLock:
+        self.db.close()
@@ -0,0 +1,255 @@
+import bisect, threading
+try:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+except ImportError:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+
+# Configure logging
+import logging as l
+
+# Default histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def formatLabels(labels):
+  if not labels:
+    return ""
+  return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + "}"
+
+def formatValue(value):
+  if value == float('inf'):
+    return "+Inf"
+  return repr(float(value))
+
+# A metric family, e.g. a counter, with a child per combination of label values
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelNames=()):
+      self.name = name
+      self.help = help
+      self.labelNames = tuple(labelNames)
+      self.children = {}
+      self.lock = threading.Lock()
+
+    def labels(self, *values):
+      with self.lock:
+        child = self.children.get(values)
+        if child is None:
+          child = self.children[values] = self.newChild()
+        return child
+
+    def render(self):
+      lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+      for values, child in sorted(self.children.items()):
+        for suffix, extraLabels, value in child.samples():
+          labels = list(zip(self.labelNames, values)) + extraLabels
+          lines.append("{}{}{} {}".format(self.name, suffix, formatLabels(labels), formatValue(value)))
+      return lines
+
+class CounterValue(object):
+    def __init__(self):
+      self.value = 0
+      self.function = None
+      self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+      with self.lock:
+        self.value += amount
+
+    # Take the value from a count kept elsewhere when metrics are collected
+    def setFunction(self, function):
+      self.function = function
+
+    def samples(self):
+      if self.function is not None:
+        return [("", [], self.function())]
+      return [("", [], self.value)]
+
+class Counter(Metric):
+    kind = "counter"
+    newChild = CounterValue
+
+    def inc(self, amount=1):
+      self.labels().inc(amount)
+
+class GaugeValue(object):
+    def __init__(self):
+      self.value = 0
+      self.function = None
+
+    def set(self, value):
+      self.value = value
+
+    # Compute the value when metrics are collected
+    def setFunction(self, function):
+      self.function = function
+
+    def samples(self):
+      value = self.value
+      if self.function is not None:
+        try:
+          value = self.function()
+        except Exception as e:
+          l.debug("Collecting gauge failed: {}".format(e))
+          return []
+      if value is None:
+        return []
+      return [("", [], value)]
+
+class Gauge(Metric):
+    kind = "gauge"
+    newChild = GaugeValue
+
+    def set(self, value):
+      self.labels().set(value)
+
+    def setFunction(self, function):
+      self.labels().setFunction(function)
+
+class HistogramValue(object):
+    def __init__(self, buckets):
+      self.buckets = buckets
+      self.counts = [0] * (len(buckets) + 1)
+      self.sum = 0.0
+      self.lock = threading.Lock()
+
+    def observe(self, value):
+      with self.lock:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+      with self.lock:
+        counts, total = list(self.counts), self.sum
+      samples, cumulative = [], 0
+      for bound, count in zip(list(self.buckets) + [float('inf')], counts):
+        cumulative += count
+        samples.append(("_bucket", [("le", formatValue(bound))], cumulative))
+      samples.append(("_sum", [], total))
+      samples.append(("_count", [], cumulative))
+      return samples
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=BUCKETS):
+      super(Histogram,self).__init__(name, help, labelNames)
+      self.buckets = tuple(sorted(buckets))
+
+    def newChild(self):
+      return HistogramValue(self.buckets)
+
+    def observe(self, value):
+      self.labels().observe(value)
+
+# Set of metrics rendered together in Prometheus text format
+class Registry(object):
+    def __init__(self):
+      self.metrics = []
+
+    def add(self, metric):
+      self.metrics.append(metric)
+      return metric
+
+    def counter(self, name, help, labelNames=()):
+      return self.add(Counter(name, help, labelNames))
+
+    def gauge(self, name, help, labelNames=()):
+      return self.add(Gauge(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=BUCKETS):
+      return self.add(Histogram(name, help, labelNames, buckets))
+
+    def render(self):
+      lines = []
+      for metric in self.metrics:
+        lines.extend(metric.render())
+      return "\n".join(lines) + "\n"
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# Serve metrics of the registry at http://host:port/metrics in a background thread
+def serve(registry, port, host=''):
+  class MetricsHandler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+          self.send_error(404)
+          return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+  server = ThreadingHTTPServer((host, port), MetricsHandler)
+  thread = threading.Thread(target=server.serve_forever, name='metrics')
+  thread.daemon = True
+  thread.start()
+  l.info("Serving metrics on port {}".format(port))
+  return server
+
+# Metrics describing the ingestion of files from a space
+class IngestionMetrics(object):
+    def __init__(self, registry=None):
+      self.registry = registry or Registry()
+      self.timings = self.registry.histogram("onedata_ingest_duration_seconds",
+        "Time spent in each step of processing a file", ["timing"])
+      self.files = self.registry.counter("onedata_ingest_files_total",
+        "Files that left the pipeline, by result", ["status"])
+      self.queueDepth = self.registry.gauge("onedata_ingest_queue_depth",
+        "Number of changes waiting in a queue", ["queue"])
+      self.inFlight = self.registry.gauge("onedata_ingest_in_flight_files",
+        "Files taken from the queue and not finished yet")
+      self.streamSeq = self.registry.gauge("onedata_ingest_stream_seq",
+        "Sequence number of the newest change read from the stream", ["space"])
+      self.committedSeq = self.registry.gauge("onedata_ingest_committed_seq",
+        "Sequence number below which all changes are processed", ["space"])
+      self.lag = self.registry.gauge("onedata_ingest_stream_lag",
+        "Difference between the newest read and the committed sequence number", ["space"])
+      self.streamEvents = self.registry.counter("onedata_ingest_stream_events_total",
+        "Events read from the changes stream and accepted for ingestion", ["result", "space"])
+      self.stageWorkers = self.registry.gauge("onedata_ingest_stage_workers",
+        "Number of workers allowed to work at a time in a pipeline stage", ["stage"])
+      self.stageBusy = self.registry.gauge("onedata_ingest_stage_busy_workers",
+        "Number of workers working in a pipeline stage", ["stage"])
+
+    def taskDone(self, task):
+      self.files.labels(task.status).inc()
+      for name, value in task.timings.items():
+        self.timings.labels(name).observe(value)
+
+    def watchQueue(self, name, queue):
+      self.queueDepth.labels(name).setFunction(queue.qsize)
+
+    def watchCoalescer(self, coalescer, name="coalescing"):
+      self.queueDepth.labels(name).setFunction(lambda: len(coalescer.pending))
+
+    def watchPipeline(self, pipeline):
+      self.queueDepth.labels("pipeline").setFunction(pipeline.queueSize)
+      self.inFlight.setFunction(lambda: pipeline.inFlight)
+      for stage in pipeline.stages:
+        self.stageWorkers.labels(stage.name).setFunction(lambda stage=stage: stage.workers)
+        self.stageBusy.labels(stage.name).setFunction(lambda stage=stage: stage.busy)
+
+    # Stream of a space, streams of several spaces are told apart by its name
+    def watchStream(self, listener, checkpoint, space=""):
+      def lag():
+        newest, committed = listener.lastSequenceNumber, checkpoint.value()
+        if newest is None or committed is None:
+          return None
+        return max(0, newest - committed)
+      self.streamSeq.labels(space).setFunction(lambda: listener.lastSequenceNumber)
+      self.streamEvents.labels("read", space).setFunction(lambda: listener.eventsRead)
+      self.streamEvents.labels("accepted", space).setFunction(lambda: listener.eventsAccepted)
+      self.committedSeq.labels(space).setFunction(checkpoint.value)
+      self.lag.labels(space).setFunction(lag)
+
+    def serve(self, port):
+      return serve(self.registry, port)
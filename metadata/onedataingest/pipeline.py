@@ -0,0 +1,175 @@
+import time, threading
+try:
+  import Queue
+except ImportError:
+  import queue as Queue
+
+# Configure logging
+import logging as l
+
+# A single file travelling through the pipeline. Stages attach whatever
+# they produce (file handle, size, metadata...) as attributes of the task.
+class Task(object):
+    def __init__(self, change):
+      self.change = change
+      self.seq = change.seq
+      self.path = change.filePath
+      self.kind = change.kind
+      self.file = None
+      self.status = None
+      self.timings = {}
+      self.created = time.time()
+
+    # Call function and store how long it took under the given name
+    def timed(self, name, function, *args, **kwargs):
+      start = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        self.timings[name] = time.time() - start
+
+    def close(self):
+      if self.file is not None and not self.file.closed:
+        self.timed('fileCloseTime', self.file.close)
+
+# A processing step with its own pool of worker threads and its own bounded
+# input queue. The function gets a task and returns True to hand it over to
+# the next stage or False if the task is finished (e.g. the file was omitted).
+#
+# `maxWorkers` threads are started, but only `workers` of them run the
+# function at a time. The limit can be changed at any time with resize(),
+# e.g. by an AimdController, within `minWorkers` and `maxWorkers`.
+class Stage(object):
+    def __init__(self, name, function, workers=1, queueSize=None, minWorkers=None, maxWorkers=None):
+      self.name = name
+      self.function = function
+      self.minWorkers = min(minWorkers or workers, workers)
+      self.maxWorkers = max(maxWorkers or workers, workers)
+      self.workers = workers
+      self.queue = Queue.Queue(queueSize or 2 * self.maxWorkers)
+      self.slots = threading.Condition()
+      self.busy = 0
+      self.resetStatistics()
+
+    def resetStatistics(self):
+      self.calls = 0
+      self.errors = 0
+      self.busyTime = 0.0
+      # a task had to wait for a free slot
+      self.contended = False
+
+    def acquire(self):
+      with self.slots:
+        if self.busy >= self.workers:
+          self.contended = True
+          while self.busy >= self.workers:
+            self.slots.wait()
+        self.busy += 1
+
+    def release(self, elapsed, failed):
+      with self.slots:
+        self.busy -= 1
+        self.calls += 1
+        self.errors += 1 if failed else 0
+        self.busyTime += elapsed
+        self.slots.notify()
+
+    def resize(self, workers):
+      with self.slots:
+        self.workers = max(self.minWorkers, min(self.maxWorkers, workers))
+        self.slots.notify_all()
+        return self.workers
+
+    # Number of calls, failed calls, time spent in them and whether tasks waited
+    # for a slot, since the previous call
+    def collect(self):
+      with self.slots:
+        statistics = (self.calls, self.errors, self.busyTime, self.contended)
+        self.resetStatistics()
+        return statistics
+
+# Long lived pipeline of stages fed from a source queue.
+#
+# Every stage runs continuously, so a file is picked up as soon as it appears
+# in the source and slow provider I/O in one stage does not stall the others.
+# Hand-off queues between stages are bounded, so a slow stage holds back the
+# ones in front of it and, eventually, the producer filling the source.
+# Putting None to the source ends the pipeline once all tasks are finished.
+class Pipeline(object):
+    def __init__(self, source, stages, onDone=None):
+      self.source = source
+      self.stages = stages
+      self.onDone = onDone
+      self.inFlight = 0
+      self.lock = threading.Condition()
+      self.threads = []
+
+    def start(self):
+      for index, stage in enumerate(self.stages):
+        for i in range(stage.maxWorkers):
+          self.spawn(self.work, "{}-{}".format(stage.name, i), index)
+      self.feeder = self.spawn(self.feed, "feeder")
+
+    def spawn(self, target, name, *args):
+      thread = threading.Thread(target=target, name=name, args=args)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+      return thread
+
+    # Block until the source is exhausted and all tasks are finished
+    def join(self):
+      while self.feeder.is_alive():
+        self.feeder.join(1)
+
+    def queueSize(self):
+      return sum(stage.queue.qsize() for stage in self.stages)
+
+    def feed(self):
+      while True:
+        change = self.source.get()
+        if change is None:
+          break
+        with self.lock:
+          self.inFlight += 1
+        self.stages[0].queue.put(Task(change))
+      with self.lock:
+        while self.inFlight > 0:
+          self.lock.wait(1)
+
+    def work(self, index):
+      stage = self.stages[index]
+      while True:
+        task = stage.queue.get()
+        stage.acquire()
+        start = time.time()
+        try:
+          passed = stage.function(task)
+        except Exception as e:
+          l.info("Stage {} failed for {}: {}".format(stage.name, task.path, e))
+          task.status = 'failed'
+          task.error = e
+          passed = False
+        stage.release(time.time() - start, task.status == 'failed')
+        if passed and index + 1 < len(self.stages):
+          self.stages[index + 1].queue.put(task)
+        else:
+          if passed:
+            task.status = task.status or 'processed'
+          self.finish(task)
+
+    def finish(self, task):
+      task.status = task.status or 'skipped'
+      try:
+        task.close()
+      except Exception as e:
+        l.info("Closing {} failed: {}".format(task.path, e))
+      task.timings['wholeTime'] = time.time() - task.created
+      if self.onDone:
+        try:
+          self.onDone(task)
+        except Exception as e:
+          l.info("Finishing {} failed: {}".format(task.path, e))
+      with self.lock:
+        self.inFlight -= 1
+        self.lock.notify_all()
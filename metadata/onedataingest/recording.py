@@ -0,0 +1,205 @@
+import os, re, gzip, json, time, zlib, threading
+
+from onedataingest.changes import ChangesListener, SEQ
+
+# Configure logging
+import logging as l
+
+SEGMENT = re.compile(r"^stream-(\d+)\.jsonl\.gz$")
+INDEX = "index.json"
+
+def segmentName(firstSeq):
+  return "stream-{:012d}.jsonl.gz".format(firstSeq)
+
+# Records the raw changes stream in gzip compressed segment files.
+#
+# Every event is written as it came from the provider, preceded by the time
+# it was received. A segment holds up to `segmentEvents` events and is named
+# after the sequence number of its first event, the sequence number of its
+# last event is kept in index.json, so a replay finds where a sequence number
+# is without reading segments before it. Data is flushed by a background
+# thread every `flushInterval` seconds; when the process dies, the
+# segment ends with the last flushed event. Such a segment is cut off after
+# its last complete event when the recorder starts again, so it is never
+# appended to. Events up to the last recorded one are not recorded again
+# when the stream is restarted from an earlier sequence number, e.g. from
+# a checkpoint.
+class StreamRecorder(object):
+    def __init__(self, directory, segmentEvents=100000, flushInterval=1.0):
+      self.directory = directory
+      self.segmentEvents = segmentEvents
+      self.flushInterval = flushInterval
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      self.lock = threading.Lock()
+      self.writer = None
+      self.segment = None
+      self.events = 0
+      self.lastSeq = None
+      # events up to this one are recorded already
+      self.recorded = max(list(self.recover().values()) or [-1])
+      self.dirty = False
+      self.stopped = threading.Event()
+      self.flusher = threading.Thread(target=self.flushLoop, name='recorder-flusher')
+      self.flusher.daemon = True
+      self.flusher.start()
+
+    def record(self, line):
+      seq = SEQ.search(line)
+      if seq is None or int(seq.group(1)) <= self.recorded:
+        return
+      with self.lock:
+        if self.stopped.is_set():
+          return
+        if self.writer is None:
+          self.segment = segmentName(int(seq.group(1)))
+          self.writer = gzip.open(os.path.join(self.directory, self.segment), "wb")
+          self.events = 0
+        self.writer.write(entry(time.time(), line))
+        self.events += 1
+        self.lastSeq = int(seq.group(1))
+        self.dirty = True
+        if self.events >= self.segmentEvents:
+          self.closeSegment()
+
+    def flushLoop(self):
+      while not self.stopped.wait(self.flushInterval):
+        with self.lock:
+          if self.writer is not None and self.dirty:
+            self.writer.flush()
+            self.dirty = False
+
+    def closeSegment(self):
+      self.writer.close()
+      self.writer = None
+      index = loadIndex(self.directory)
+      index[self.segment] = self.lastSeq
+      self.saveIndex(index)
+
+    def saveIndex(self, index):
+      path = os.path.join(self.directory, INDEX)
+      with open(path + ".tmp", "w") as f:
+        json.dump(index, f)
+      os.rename(path + ".tmp", path)
+
+    # Rewrite segments which were not closed with their complete events and add them
+    # to the index, segments without any are removed. Returns the index.
+    def recover(self):
+      index = loadIndex(self.directory)
+      recording = Recording(self.directory)
+      for firstSeq, lastSeq, name in recording.segments():
+        if lastSeq is not None:
+          continue
+        path = os.path.join(self.directory, name)
+        with gzip.open(path + ".tmp", "wb") as f:
+          for received, line in recording.read(name):
+            f.write(entry(received, line))
+            lastSeq = int(SEQ.search(line).group(1))
+        if lastSeq is None:
+          l.info("Removing segment {} without complete events".format(name))
+          os.remove(path + ".tmp")
+          os.remove(path)
+          continue
+        l.info("Recovered segment {} up to seq={}".format(name,lastSeq))
+        os.rename(path + ".tmp", path)
+        index[name] = lastSeq
+      self.saveIndex(index)
+      return index
+
+    def close(self):
+      self.stopped.set()
+      self.flusher.join()
+      with self.lock:
+        if self.writer is not None:
+          self.closeSegment()
+
+# Line of a segment with an event received at the given time
+def entry(received, line):
+  return "{:.3f} ".format(received).encode('utf-8') + line + b"\n"
+
+def loadIndex(directory):
+  try:
+    with open(os.path.join(directory, INDEX)) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+
+# Changes stream recorded by a StreamRecorder
+class Recording(object):
+    def __init__(self, directory):
+      self.directory = directory
+
+    # (first seq, last seq or None if not known, name) of every segment, oldest first
+    def segments(self):
+      index = loadIndex(self.directory)
+      segments = []
+      for name in os.listdir(self.directory):
+        match = SEGMENT.match(name)
+        if match:
+          segments.append((int(match.group(1)), index.get(name), name))
+      return sorted(segments)
+
+    # Receive time and line of every recorded event from the given sequence number on.
+    # Segments of a recording restarted from an earlier sequence number overlap,
+    # events already yielded are skipped.
+    def events(self, fromSeq=0):
+      last = fromSeq - 1
+      segments = self.segments()
+      for i, (firstSeq, lastSeq, name) in enumerate(segments):
+        # the segment ends before the sequence number
+        if lastSeq is not None and lastSeq < fromSeq:
+          continue
+        if i + 1 < len(segments) and segments[i + 1][0] <= fromSeq:
+          continue
+        for received, line in self.read(name):
+          seq = int(SEQ.search(line).group(1))
+          if seq <= last:
+            continue
+          last = seq
+          yield received, line
+
+    def read(self, name):
+      try:
+        with gzip.open(os.path.join(self.directory, name), "rb") as f:
+          for line in f:
+            if not line.endswith(b"\n"):
+              break
+            received, line = line.rstrip(b"\n").split(b" ", 1)
+            yield float(received), line
+      except (EOFError, IOError, zlib.error) as e:
+        # the recorder died before it closed the segment
+        l.debug("Segment {} ends early: {}".format(name,e))
+
+# Feeds a recorded changes stream to the ingestion instead of the provider.
+#
+# Events are replayed from `startingSequenceNumber` at full speed, or with
+# `speed` > 0 at that many times the rate they were recorded at. They are
+# filtered and queued exactly like a live stream, when the recording ends
+# None is put to the queue, so the ingestion ends once all changes are
+# processed.
+class ReplayListener(ChangesListener):
+    def __init__(self, directory, queue, accept=None, startingSequenceNumber=None, speed=0,
+                 checkpoint=None, reportInterval=60, name='replay'):
+      super(ReplayListener,self).__init__(None, None, None, queue, accept=accept,
+                                          startingSequenceNumber=startingSequenceNumber, checkpoint=checkpoint,
+                                          reportInterval=reportInterval, name=name)
+      self.recording = Recording(directory)
+      self.speed = speed
+
+    def run(self):
+      start = None
+      fromSeq = int(self.startingSequenceNumber or 0)
+      l.info("Replaying changes from seq={} recorded in {}".format(fromSeq,self.recording.directory))
+      for received, line in self.recording.events(fromSeq):
+        if self.stopped.is_set():
+          return
+        if self.speed > 0:
+          if start is None:
+            start = (time.time(), received)
+          delay = start[0] + (received - start[1]) / self.speed - time.time()
+          if delay > 0:
+            self.stopped.wait(delay)
+        self.receive(line)
+      self.report()
+      l.info("Replay ended at seq={}".format(self.lastSequenceNumber))
+      self.queue.put(None)
@@ -0,0 +1,106 @@
+import os, json, time, hashlib, threading, concurrent.futures
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# Disable warnings about red https
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+# Configure logging
+import logging as l
+
+# Client of the Onezone and Oneprovider REST APIs shared by a whole script.
+#
+# All requests go through one session with a pool of keep-alive
+# connections per host, so TLS handshakes are done once per connection
+# instead of once per request, and independent requests (e.g. details of
+# many spaces) run concurrently on up to `poolSize` connections.
+class RestClient(object):
+    def __init__(self, onezoneUrl, apiToken, verify=False, poolSize=16, retries=3, timeout=60):
+      self.onezoneUrl = onezoneUrl.rstrip('/')
+      self.apiToken = apiToken
+      self.poolSize = poolSize
+      self.timeout = timeout
+      self.session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolSize, max_retries=retries)
+      self.session.mount('https://', adapter)
+      self.session.mount('http://', adapter)
+      self.session.headers.update({'X-Auth-Token': apiToken })
+      self.session.verify = verify
+
+    def get(self, url, **kwargs):
+      kwargs.setdefault('timeout', self.timeout)
+      response = self.session.get(url, **kwargs)
+      response.raise_for_status()
+      return response.json()
+
+    def userSpaces(self):
+      return self.get("{}/api/v3/onezone/user/spaces".format(self.onezoneUrl))['spaces']
+
+    def space(self, spaceId):
+      return self.get("{}/api/v3/onezone/spaces/{}".format(self.onezoneUrl,spaceId))
+
+    # Ids of all spaces of the user with the given name, details of spaces are fetched concurrently.
+    # With a cache a remembered id is only checked to still belong to the space of that name.
+    def spaceIds(self, spaceName, cache=None):
+      if cache is not None:
+        spaceId = cache.get(self.onezoneUrl, self.apiToken, spaceName)
+        if spaceId is not None:
+          try:
+            if self.space(spaceId)['name'] == spaceName:
+              return [spaceId]
+          except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            l.debug("Cached space id {} of {} is not valid: {}".format(spaceId,spaceName,e))
+      spaces = self.userSpaces()
+      with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.poolSize, len(spaces)))) as executor:
+        spaceIds = [space['spaceId'] for space in executor.map(self.space, spaces) if space['name'] == spaceName]
+      if cache is not None and len(spaceIds) == 1:
+        cache.put(self.onezoneUrl, self.apiToken, spaceName, spaceIds[0])
+      return spaceIds
+
+    def close(self):
+      self.session.close()
+
+# Space ids resolved from names, kept in a JSON file for `ttl` seconds.
+#
+# Entries are specific to the Onezone and the token (only a hash of the
+# token is stored), as different users may have different spaces of the
+# same name.
+class SpaceCache(object):
+    def __init__(self, path, ttl=86400):
+      self.path = path
+      self.ttl = ttl
+      self.lock = threading.Lock()
+
+    def key(self, onezoneUrl, apiToken, spaceName):
+      return "{} {} {}".format(onezoneUrl, hashlib.sha1(apiToken.encode('utf-8')).hexdigest()[:16], spaceName)
+
+    def load(self):
+      try:
+        with open(self.path) as f:
+          return json.load(f)
+      except (IOError, OSError, ValueError):
+        return {}
+
+    def get(self, onezoneUrl, apiToken, spaceName):
+      with self.lock:
+        entry = self.load().get(self.key(onezoneUrl, apiToken, spaceName))
+      if entry is None or time.time() - entry['time'] > self.ttl:
+        return None
+      return entry['spaceId']
+
+    def put(self, onezoneUrl, apiToken, spaceName, spaceId):
+      with self.lock:
+        entries = self.load()
+        now = time.time()
+        entries = dict((key, entry) for key, entry in entries.items() if now - entry['time'] <= self.ttl)
+        entries[self.key(onezoneUrl, apiToken, spaceName)] = { "spaceId": spaceId, "time": now }
+        directory = os.path.dirname(self.path)
+        try:
+          if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+          with open(self.path + ".tmp", "w") as f:
+            json.dump(entries, f)
+          os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError) as e:
+          l.info("Saving space cache {} failed: {}".format(self.path,e))
@@ -0,0 +1,148 @@
+import os, sys, time, zlib, signal, argparse, subprocess
+
+from onedataingest.checkpoint import CheckpointTracker
+from onedataingest.fairqueue import parseWeights
+
+# Configure logging
+import logging as l
+
+# Ingestion of a space split between processes, possibly on several hosts.
+#
+# Every file belongs to one of SHARD_COUNT shards, by a hash of its path
+# which is the same in every process, so all changes of a file are ingested
+# by the same shard, in order. Each shard reads the changes stream on its
+# own and only queues changes of its files. Its state (queue on disk and
+# checkpoint) is kept in a directory of its own, shard-<index>-of-<count>
+# next to the state of an ingestion which is not split. The global
+# commit, the lowest sequence number committed by all shards, is saved
+# as the checkpoint of that ingestion - a shard without a checkpoint of its
+# own (e.g. when the number of shards changes) starts from it.
+
+CHECKPOINT = "checkpoint.seq"
+
+# Shard of a file with the given path, out of `count`
+def shardOf(path, count):
+  if not isinstance(path, bytes):
+    path = path.encode('utf-8')
+  return (zlib.crc32(path) & 0xffffffff) % count
+
+# Accept function of a changes listener, taking only files of the given shard
+def shardFilter(accept, index, count):
+  if count <= 1:
+    return accept
+  def acceptShard(path):
+    if shardOf(path, count) != index:
+      return None
+    return accept(path) if accept else True
+  return acceptShard
+
+# Directory with the state of a shard, in the directory with the state of the whole ingestion
+def shardDirectory(directory, index, count):
+  return os.path.join(directory, "shard-{}-of-{}".format(index, count))
+
+# File of a shard, e.g. an index of ingested files, next to the file of the whole ingestion
+def shardFile(path, index, count):
+  root, extension = os.path.splitext(path)
+  return "{}-shard-{}-of-{}{}".format(root, index, count, extension)
+
+# Lowest sequence number committed by all shards, None until each of them committed one
+def globalCommit(directory, count):
+  committed = None
+  for index in range(count):
+    seq = CheckpointTracker(os.path.join(shardDirectory(directory, index, count), CHECKPOINT)).committed
+    if seq is None:
+      return None
+    committed = seq if committed is None else min(committed, seq)
+  return committed
+
+# Save the global commit as the checkpoint of the whole ingestion, unless it is older than the saved one
+def saveGlobalCommit(directory, count):
+  committed = globalCommit(directory, count)
+  path = os.path.join(directory, CHECKPOINT)
+  saved = CheckpointTracker(path).committed
+  if committed is None or (saved is not None and committed <= saved):
+    return saved
+  # launchers on other hosts may save it at the same time
+  temporaryPath = "{}.{}.tmp".format(path, os.getpid())
+  with open(temporaryPath, "w") as f:
+    f.write(str(committed))
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(temporaryPath, path)
+  return committed
+
+# Shards given as a list of indexes and ranges, e.g. 0-3,8
+def parseShards(value, count):
+  if not value:
+    return list(range(count))
+  shards = []
+  for part in value.split(','):
+    first, _, last = part.partition('-')
+    shards.extend(range(int(first), int(last or first) + 1))
+  for index in shards:
+    if not 0 <= index < count:
+      raise ValueError("Shard {} does not exist, there are {} shards".format(index, count))
+  return shards
+
+# Runs shards of an ingestion script as processes of this host and saves the global commit
+def main():
+  l.basicConfig(level=l.INFO, format='%(message)s')
+  parser = argparse.ArgumentParser(description="Run shards of an ingestion script, SHARD_COUNT processes by default")
+  parser.add_argument('script', help="ingestion script, e.g. run.py")
+  parser.add_argument('--count', type=int, default=int(os.environ.get('SHARD_COUNT', 1)),
+                      help="number of shards of the whole ingestion (SHARD_COUNT)")
+  parser.add_argument('--shards', default=os.environ.get('SHARD_INDEX'),
+                      help="shards run on this host, e.g. 0-3,8, all by default (SHARD_INDEX)")
+  parser.add_argument('--state', action='append',
+                      help="directory with state of the ingestion, to save the global commit in, can be repeated "
+                           "(QUEUE_DIR, or its subdirectory of each space of SPACE_NAMES)")
+  parser.add_argument('--interval', type=float, default=10, help="seconds between saves of the global commit")
+  args = parser.parse_args()
+  states = args.state
+  if states is None and os.environ.get('QUEUE_DIR'):
+    # with several spaces each has its own state and global commit
+    spaces = parseWeights(os.environ.get('SPACE_NAMES') or "")
+    states = [os.path.join(os.environ['QUEUE_DIR'], name) for name in spaces] if len(spaces) > 1 else [os.environ['QUEUE_DIR']]
+
+  metricsPort = int(os.environ.get('METRICS_PORT', 0))
+  processes = {}
+  for index in parseShards(args.shards, args.count):
+    env = dict(os.environ, SHARD_COUNT=str(args.count), SHARD_INDEX=str(index))
+    if metricsPort:
+      # every shard serves its own metrics
+      env['METRICS_PORT'] = str(metricsPort + index)
+    processes[index] = subprocess.Popen([sys.executable, args.script], env=env)
+    l.info("Started shard {} of {}, pid={}".format(index, args.count, processes[index].pid))
+
+  def stop(signum, frame):
+    for process in processes.values():
+      if process.poll() is None:
+        process.send_signal(signum)
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  committed = {}
+  def save():
+    for state in states or []:
+      try:
+        seq = saveGlobalCommit(state, args.count)
+      except (IOError, OSError) as e:
+        l.info("Saving the global commit to {} failed: {}".format(state, e))
+        continue
+      if seq != committed.get(state):
+        l.info("Global commit seq={} in {}".format(seq, state))
+        committed[state] = seq
+
+  saved = time.time()
+  while any(process.poll() is None for process in processes.values()):
+    time.sleep(min(args.interval, 1))
+    if time.time() - saved >= args.interval:
+      saved = time.time()
+      save()
+  save()
+  for index, process in sorted(processes.items()):
+    l.info("Shard {} exited with {}".format(index, process.returncode))
+  sys.exit(max(abs(process.returncode) for process in processes.values()))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,218 @@
+import os, re, json, threading
+from collections import deque
+try:
+  import Queue
+except ImportError:
+  import queue as Queue
+
+# Configure logging
+import logging as l
+
+SEGMENT = re.compile(r"^segment-(\d+)\.log$")
+
+# Unbounded FIFO queue kept in append-only segment files on local disk.
+#
+# Every item put is appended (as a JSON line) to the newest segment file, so
+# nothing queued is lost when the process dies. Only the head of the queue,
+# up to `memoryItems` items, is also kept in memory; once more items wait,
+# they are read back from the segment files in batches when the head runs
+# out, so memory stays bounded however long the backlog gets. put() never
+# blocks, a reader of a stream putting items is never held back.
+#
+# Items taken with get() have to be acknowledged with ack() once they are
+# done with. A segment file is deleted when all its items are acknowledged.
+# When the queue is created again on the same directory, items of segments
+# left behind (not acknowledged, possibly including some which were) are
+# queued again, followed by new ones.
+class SpillQueue(object):
+    # Items do not need to be tracked as in flight until they are got, they are safe on disk
+    durable = True
+
+    def __init__(self, directory, memoryItems=1000, segmentItems=10000, encode=list, decode=tuple):
+      self.directory = directory
+      self.memoryItems = memoryItems
+      self.segmentItems = segmentItems
+      self.encode = encode
+      self.decode = decode
+      self.lock = threading.Condition()
+      # (item, segment) pairs at the head of the queue
+      self.hot = deque()
+      # Number of items only on disk, following the hot ones
+      self.spilled = 0
+      # segment id -> [items written, items acknowledged, still written to]
+      self.segments = {}
+      # seq -> segments of items got but not acknowledged yet
+      self.unacked = {}
+      self.writer = None
+      self.writerSegment = None
+      # Segment and index in it of the first item only on disk, and the file it is read from
+      self.cursor = None
+      self.reader = None
+      self.ended = False
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      self.reload()
+
+    def segmentPath(self, segment):
+      return os.path.join(self.directory, "segment-{:012d}.log".format(segment))
+
+    # Count items of segments left by a previous run, they are all queued again
+    def reload(self):
+      for name in sorted(os.listdir(self.directory)):
+        match = SEGMENT.match(name)
+        if not match:
+          continue
+        segment = int(match.group(1))
+        count = 0
+        with open(self.segmentPath(segment), "rb") as f:
+          for line in f:
+            if self.parse(line) is not None:
+              count += 1
+        if count == 0:
+          os.remove(self.segmentPath(segment))
+          continue
+        self.segments[segment] = [count, 0, False]
+        self.spilled += count
+        if self.cursor is None:
+          self.cursor = (segment, 0)
+      if self.segments:
+        l.info("Reloaded {} queued items from {} segments in {}".format(self.spilled,len(self.segments),self.directory))
+
+    # Item of a line of a segment, None for a line cut short by a crash
+    def parse(self, line):
+      if not line.endswith(b"\n"):
+        return None
+      try:
+        return self.decode(json.loads(line.decode('utf-8')))
+      except ValueError:
+        return None
+
+    def write(self, item):
+      if self.writer is None or self.segments[self.writerSegment][0] >= self.segmentItems:
+        if self.writer is not None:
+          self.writer.close()
+          self.segments[self.writerSegment][2] = False
+          self.release(self.writerSegment)
+        self.writerSegment = max(self.segments) + 1 if self.segments else 0
+        self.writer = open(self.segmentPath(self.writerSegment), "ab")
+        self.segments[self.writerSegment] = [0, 0, True]
+      self.writer.write((json.dumps(self.encode(item)) + "\n").encode('utf-8'))
+      # the item survives a crash of the process from now on
+      self.writer.flush()
+      self.segments[self.writerSegment][0] += 1
+      return self.writerSegment
+
+    def put(self, item, block=True, timeout=None):
+      with self.lock:
+        if item is None:
+          # end of the input, not persisted
+          self.ended = True
+        else:
+          segment = self.write(item)
+          if self.spilled == 0 and len(self.hot) < self.memoryItems:
+            self.hot.append((item, segment))
+          else:
+            if self.spilled == 0:
+              # items from this one on are read back from disk
+              self.cursor = (segment, self.segments[segment][0] - 1)
+              self.closeReader()
+            self.spilled += 1
+        self.lock.notify()
+
+    def get(self, block=True, timeout=None):
+      with self.lock:
+        if block:
+          if timeout is None:
+            while not self.hot and not self.spilled and not self.ended:
+              self.lock.wait()
+          elif not self.hot and not self.spilled and not self.ended:
+            self.lock.wait(timeout)
+        if not self.hot and self.spilled:
+          self.readBatch()
+        if not self.hot:
+          if self.ended:
+            return None
+          raise Queue.Empty()
+        item, segment = self.hot.popleft()
+        self.unacked.setdefault(self.seqOf(item), []).append(segment)
+        return item
+
+    def seqOf(self, item):
+      return item[0]
+
+    # Move the next items only on disk to memory
+    def readBatch(self):
+      while len(self.hot) < self.memoryItems and self.spilled:
+        segment, index = self.cursor
+        if self.reader is None:
+          self.reader = open(self.segmentPath(segment), "rb")
+          skipped = 0
+          while skipped < index:
+            if self.parse(self.reader.readline()) is not None:
+              skipped += 1
+        line = self.reader.readline()
+        if not line:
+          # the rest is in the next segment
+          self.closeReader()
+          self.cursor = (min(other for other in self.segments if other > segment), 0)
+          continue
+        item = self.parse(line)
+        if item is None:
+          continue
+        self.hot.append((item, segment))
+        self.spilled -= 1
+        self.cursor = (segment, index + 1)
+
+    def closeReader(self):
+      if self.reader is not None:
+        self.reader.close()
+        self.reader = None
+
+    def ack(self, item):
+      with self.lock:
+        segments = self.unacked.get(self.seqOf(item))
+        if not segments:
+          return
+        segment = segments.pop(0)
+        if not segments:
+          del self.unacked[self.seqOf(item)]
+        self.segments[segment][1] += 1
+        self.release(segment)
+
+    # Delete a segment which is not written to any more and whose items are all acknowledged
+    def release(self, segment):
+      written, acknowledged, writing = self.segments[segment]
+      if writing or acknowledged < written:
+        return
+      del self.segments[segment]
+      if self.cursor is not None and self.cursor[0] == segment:
+        # everything in it was read, go on with the next one
+        self.closeReader()
+        later = [other for other in self.segments if other > segment]
+        self.cursor = (min(later), 0) if later else None
+      try:
+        os.remove(self.segmentPath(segment))
+      except OSError as e:
+        l.info("Removing queue segment {} failed: {}".format(segment,e))
+
+    # Make queued items survive a crash of the machine, not only of the process
+    def sync(self):
+      with self.lock:
+        if self.writer is not None:
+          os.fsync(self.writer.fileno())
+
+    def qsize(self):
+      with self.lock:
+        return len(self.hot) + self.spilled
+
+    def empty(self):
+      return self.qsize() == 0
+
+    def close(self):
+      with self.lock:
+        if self.writer is not None:
+          self.writer.close()
+          self.writer = None
+          self.segments[self.writerSegment][2] = False
+          self.release(self.writerSegment)
+        self.closeReader()
@@ -0,0 +1,122 @@
+import os, json
+
+from onedataingest.pipeline import Stage
+from onedataingest.digests import metadataDigest, fileSignature, storedDigest
+from onedataingest.blockcache import CachedReader
+
+# Configure logging
+import logging as l
+
+# Stage of a pipeline configured with <NAME>_WORKERS, <NAME>_MIN_WORKERS and <NAME>_MAX_WORKERS.
+# With adaptive concurrency the number of its workers is adapted between the last two,
+# otherwise it keeps <NAME>_WORKERS workers.
+def stage(name, function, workers, maxWorkers, adaptive=True):
+  prefix = name.upper()
+  workers = int(os.environ.get(prefix + '_WORKERS', workers))
+  if not adaptive:
+    return Stage(name, function, workers=workers)
+  return Stage(name, function, workers=workers, minWorkers=int(os.environ.get(prefix + '_MIN_WORKERS', 1)),
+               maxWorkers=int(os.environ.get(prefix + '_MAX_WORKERS', maxWorkers)))
+
+# Processing stages ingesting metadata of files, shared by the samples.
+#
+# A file is checked whether it changed since it was ingested and opened,
+# its metadata is extracted and attached to it. Files are read through
+# OnedataFS `odfs`, in cached blocks with `readerOptions`, or by processes
+# of `extractorPool`, which open them on their own. Ingested files are
+# remembered in `ingestedFiles`. A finished task is passed to `onDone`,
+# counted in `metrics` and, with `jsonLog`, its timings are logged along
+# with the size of `queue`.
+class IngestionStages(object):
+    def __init__(self, odfs, extractors, ingestedFiles, metrics, extractorPool=None, readerOptions=None,
+                 onDone=None, jsonLog=True, queue=None):
+      self.odfs = odfs
+      self.extractors = extractors
+      self.ingestedFiles = ingestedFiles
+      self.metrics = metrics
+      self.extractorPool = extractorPool
+      self.readerOptions = readerOptions
+      self.onDone = onDone
+      self.jsonLog = jsonLog
+      self.queue = queue
+
+    # Processing stage: check if a file changed since it was ingested and open it
+    def openFile(self, task):
+      # a walk lists files with their details
+      info = getattr(task.change, 'info', None)
+      if info is None or not info.has_namespace('details'):
+        l.debug("Getting size of file: {}".format(task.path))
+        info = task.timed('filegetInfoTime', self.odfs.getinfo, task.path, namespaces=['details'])
+      task.size = info.size
+      task.signature = fileSignature(info)
+      l.debug("Size of file {} is: {}".format(task.path,task.size))
+      if task.size == 0:
+        l.debug("size zero, omitting {}".format(task.path))
+        return False
+      # Most likely the change was caused by attaching metadata to the file
+      if self.ingestedFiles.isCurrent(task.path, task.signature):
+        l.debug("content not changed since ingestion, omitting {}".format(task.path))
+        return False
+      task.fileName = task.path
+      # Pool processes open files on their own
+      if self.extractorPool is None:
+        l.debug("Opening file: {}".format(task.path))
+        # Extraction only reads the file, so do not lock it for writing
+        task.file = task.timed('fileOpenTime', self.odfs.openbin, task.path, mode="r")
+        task.fileName = task.file.path
+        if self.readerOptions is not None:
+          task.file = CachedReader(task.file, **self.readerOptions)
+        # The name only suggests the format, the header of the file tells it
+        task.extractor = self.extractors.identify(task.file, task.kind)
+        if task.extractor is None:
+          l.debug("unknown format, omitting {}".format(task.path))
+          return False
+      return True
+
+    # Processing stage: extract metadata from an opened file
+    def extractMetadata(self, task):
+      l.debug("Extracting metadata from file: {}".format(task.path))
+      if self.extractorPool is None:
+        task.metadata = task.timed('metadataExtractTime', task.extractor.extract, task.file, task.size)
+        if self.readerOptions is not None:
+          l.debug("Read {} bytes of {} in {} requests".format(task.file.bytesFetched,task.path,task.file.requests))
+      else:
+        task.metadata = task.timed('metadataExtractTime', self.extractorPool.extract, task.fileName, task.kind, task.size)
+        if task.metadata is None:
+          l.debug("unknown format, omitting {}".format(task.path))
+          return False
+      return True
+
+    # Processing stage: attach metadata to a file and close it
+    def attachMetadata(self, task):
+      # Writing the same metadata again would only trigger another change of the file
+      digest = metadataDigest(task.metadata)
+      if self.ingestedFiles.isStored(task.path, digest) or storedDigest(self.odfs, task.fileName) == digest:
+        l.debug("metadata not changed, omitting {}".format(task.path))
+        self.ingestedFiles.remember(task.path, task.signature, digest, task.seq)
+        return False
+      l.debug("Attaching metadata to: {}".format(task.path))
+      task.timed('metadataSettingTime', self.odfs.setxattr, task.fileName, "onedata_json", json.dumps(task.metadata))
+      self.ingestedFiles.remember(task.path, task.signature, digest, task.seq)
+      task.close()
+      task.accessType = task.timed('getAccessTypeTime', self.odfs.getxattr, task.fileName, b"org.onedata.access_type")
+      l.debug("File={}, Access type={}, Metadata extract time={}, Metadata set with OnedataFS={}".format(task.path,task.accessType,task.timings['metadataExtractTime'],task.timings['metadataSettingTime']))
+      return True
+
+    # Log timings of each processed file
+    def logTask(self, task):
+      if self.onDone:
+        self.onDone(task)
+      self.metrics.taskDone(task)
+      if task.status != 'processed' or not self.jsonLog:
+        return
+      jsonLog = {} ;
+      jsonLog["file"] = task.fileName ; jsonLog["metadataExtrationTime"] = task.timings['metadataExtractTime'] ; jsonLog["accessType"] = str(task.accessType) ; jsonLog["metadataSettingTime"] = task.timings['metadataSettingTime'] ;
+      jsonLog['getAccessTypeTime'] = task.timings['getAccessTypeTime'] ; jsonLog['filegetInfoTime'] = task.timings.get('filegetInfoTime', 0) ; jsonLog['fileOpenTime'] = task.timings.get('fileOpenTime', 0) ;
+      jsonLog['fileCloseTime'] = task.timings.get('fileCloseTime', 0) ;
+      if hasattr(task.change, 'listDirTime'):
+        jsonLog['listDirTime'] = task.change.listDirTime
+      jsonLog['wholeTime'] = task.timings['wholeTime']
+      if self.queue is not None:
+        jsonLog['queueSize'] = self.queue.qsize()
+      l.info("jsonLog: {}".format(json.dumps(jsonLog)))
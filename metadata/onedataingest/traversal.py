@@ -0,0 +1,188 @@
+import time, threading
+from collections import deque, namedtuple
+
+from fs.errors import ResourceNotFound
+
+# Configure logging
+import logging as l
+
+# A file found by the walker, in the shape of a change of the changes stream.
+# `info` is what listing its directory told about the file (e.g. its size)
+# and `listDirTime` how long that listing took.
+FoundFile = namedtuple('FoundFile', ['seq', 'fileId', 'filePath', 'kind', 'info', 'listDirTime'])
+
+# Walks a directory tree of a filesystem with many threads at once.
+#
+# Directories waiting to be listed form the frontier, split into a deque per
+# thread. A thread lists directories from the end of its own deque (so it
+# goes depth first and the frontier stays small) and, when it has none,
+# steals from the start of another thread's deque, where the directories
+# closest to the root, likely with the largest subtrees, are. The frontier
+# is bounded by `maxFrontier` directories - when it is full, a subdirectory
+# is walked right away by the thread which found it. Directories are listed
+# in pages of `pageSize` entries and every file is passed to `onFile` as
+# soon as it is found, so neither the tree nor a whole large directory is
+# ever held in memory.
+#
+# With a WalkState, directories it reports done are not listed, only their
+# stored subdirectories are walked, and listed directories are reported to it.
+class Walker(object):
+    def __init__(self, fs, onFile, threads=8, maxFrontier=10000, pageSize=1000, namespaces=('details',),
+                 onDirectory=None, state=None):
+      self.fs = fs
+      # Called with the path of a file, its info and how long listing of the page with it took
+      self.onFile = onFile
+      # Called with the path of a directory, numbers of files and subdirectories in it
+      # and how long it took to list it
+      self.onDirectory = onDirectory
+      self.state = state
+      self.threadCount = threads
+      self.maxFrontier = maxFrontier
+      self.pageSize = pageSize
+      self.namespaces = list(namespaces)
+      self.deques = [deque() for i in range(threads)]
+      self.lock = threading.Condition()
+      # Directories in the deques and directories being walked from them
+      self.queued = 0
+      self.active = 0
+      self.directories = 0
+      self.skipped = 0
+      self.files = 0
+      self.errors = 0
+      self.threads = []
+
+    def start(self, root):
+      if isinstance(root, bytes):
+        root = root.decode('utf-8')
+      self.deques[0].append((root, None))
+      self.queued = 1
+      for index in range(self.threadCount):
+        thread = threading.Thread(target=self.work, name="walker-{}".format(index), args=(index,))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+      return self
+
+    # Wait until the whole tree is walked, False if it is not after `timeout` seconds
+    def join(self, timeout=None):
+      deadline = None if timeout is None else time.time() + timeout
+      for thread in self.threads:
+        while thread.is_alive():
+          remaining = 1 if deadline is None else deadline - time.time()
+          if remaining <= 0:
+            return False
+          thread.join(min(remaining, 1))
+      return True
+
+    def take(self, index):
+      with self.lock:
+        while True:
+          if self.deques[index]:
+            item = self.deques[index].pop()
+          else:
+            item = None
+            for offset in range(1, self.threadCount):
+              victim = self.deques[(index + offset) % self.threadCount]
+              if victim:
+                item = victim.popleft()
+                break
+          if item is not None:
+            self.queued -= 1
+            self.active += 1
+            return item
+          if self.queued == 0 and self.active == 0:
+            # nothing left to walk, nobody can find more
+            self.lock.notify_all()
+            return None
+          self.lock.wait()
+
+    # Queue a directory, with its info if known, in the thread's deque, False if the frontier is full
+    def push(self, index, directory, info=None):
+      with self.lock:
+        if self.queued >= self.maxFrontier:
+          return False
+        self.deques[index].append((directory, info))
+        self.queued += 1
+        self.lock.notify()
+        return True
+
+    def work(self, index):
+      while True:
+        item = self.take(index)
+        if item is None:
+          return
+        try:
+          self.walk(index, *item)
+        finally:
+          with self.lock:
+            self.active -= 1
+            self.lock.notify_all()
+
+    def walk(self, index, directory, info=None):
+      try:
+        self.list(index, directory, info)
+      except ResourceNotFound:
+        # removed after it was found
+        l.debug("Directory {} does not exist any more".format(directory))
+      except Exception as e:
+        l.info("Listing directory {} failed: {}".format(directory,e))
+        with self.lock:
+          self.errors += 1
+
+    def descend(self, index, directory, info=None):
+      if not self.push(index, directory, info):
+        # the frontier is full, go depth first
+        self.walk(index, directory, info)
+
+    # Signature of a directory for the walk state, from its info when it is known
+    def signature(self, directory, info, cache):
+      if not cache:
+        if info is None or not info.has_namespace('details'):
+          info = self.fs.getinfo(directory, namespaces=['details'])
+        cache.append(self.state.signature(info))
+      return cache[0]
+
+    def list(self, index, directory, info=None):
+      signature = []
+      if self.state is not None:
+        # taken before listing, so changes made while listing are seen by the next walk
+        subdirectories = self.state.skip(directory, lambda: self.signature(directory, info, signature))
+        if subdirectories is not None:
+          with self.lock:
+            self.skipped += 1
+          for name in subdirectories:
+            self.descend(index, directory.rstrip('/') + "/" + name)
+          return
+        self.signature(directory, info, signature)
+      files = 0
+      subdirectories = []
+      listDirTime = 0
+      start = 0
+      while True:
+        pageStart = time.time()
+        entries = list(self.fs.scandir(directory, namespaces=self.namespaces, page=(start, start + self.pageSize)))
+        pageTime = time.time() - pageStart
+        listDirTime += pageTime
+        for entry in entries:
+          path = directory.rstrip('/') + "/" + entry.name
+          if entry.is_dir:
+            subdirectories.append(entry.name)
+            self.descend(index, path, entry)
+          else:
+            files += 1
+            self.onFile(path, entry, pageTime)
+        if len(entries) < self.pageSize:
+          break
+        start += self.pageSize
+      with self.lock:
+        self.directories += 1
+        self.files += files
+      if self.state is not None:
+        self.state.listed(directory, signature[0], subdirectories)
+      if self.onDirectory:
+        self.onDirectory(directory, files, len(subdirectories), listDirTime)
+
+    def progress(self):
+      with self.lock:
+        return "walked {} directories, skipped {} done, found {} files, {} directories waiting, {} failed".format(
+          self.directories, self.skipped, self.files, self.queued, self.errors)
@@ -0,0 +1,147 @@
+import os, json, time, sqlite3, threading
+
+# Configure logging
+import logging as l
+
+from onedataingest.digests import fileSignature
+
+# Ways of starting a walk, see WalkState
+MODES = ('resume', 'refresh', 'full')
+
+# Progress of walks of a space kept in a local SQLite database.
+#
+# A directory is marked done in a walk once it is listed and all files
+# queued from it are finished. Along with the marker its signature (size
+# and modification time, which changes when entries are added, removed or
+# renamed) and the names of its subdirectories are stored. A directory
+# done in the current walk is not listed again, the walk only goes on with
+# its stored subdirectories, so a walk continued after a crash does not
+# queue files it already finished.
+#
+# With mode:
+# * resume - an unfinished walk is continued, otherwise a full walk starts,
+# * refresh - an unfinished walk is continued, otherwise a refresh walk
+#   starts; it does not list directories whose signature is the one stored
+#   with their marker, they only need to be looked up,
+# * full - a full walk starts, all directories are listed.
+# Markers are saved in batches, every `flushInterval` seconds.
+class WalkState(object):
+    def __init__(self, path, mode='resume', flushInterval=2.0):
+      if mode not in MODES:
+        raise ValueError("Unknown walk mode {}, use one of {}".format(mode, ", ".join(MODES)))
+      directory = os.path.dirname(path)
+      if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+      self.db = sqlite3.connect(path, check_same_thread=False)
+      self.db.execute("PRAGMA journal_mode=WAL")
+      self.db.execute("PRAGMA synchronous=NORMAL")
+      self.db.execute("CREATE TABLE IF NOT EXISTS walks (id INTEGER PRIMARY KEY, refresh INTEGER, started REAL, finished REAL)")
+      self.db.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, walk INTEGER, signature TEXT, subdirectories TEXT)")
+      self.db.commit()
+      self.dbLock = threading.Lock()
+      self.lock = threading.Lock()
+      self.flushInterval = flushInterval
+      # directory -> [files not finished yet, listed, signature, subdirectories]
+      self.walking = {}
+      self.pending = []
+      self.skipped = 0
+      self.stopped = threading.Event()
+      last = self.db.execute("SELECT id, refresh, finished FROM walks ORDER BY id DESC LIMIT 1").fetchone()
+      if mode != 'full' and last is not None and last[2] is None:
+        self.walkId, self.refresh, self.resumed = last[0], bool(last[1]), True
+      else:
+        self.refresh, self.resumed = mode == 'refresh' and last is not None, False
+        self.walkId = self.db.execute("INSERT INTO walks (refresh, started) VALUES (?, ?)",
+                                      (int(self.refresh), time.time())).lastrowid
+        self.db.commit()
+      l.info("{} {} walk {}".format("Resuming" if self.resumed else "Starting", "refresh" if self.refresh else "full", self.walkId))
+      self.flusher = threading.Thread(target=self.flushLoop, name='walk-state-flusher')
+      self.flusher.daemon = True
+      self.flusher.start()
+
+    def signature(self, info):
+      return json.dumps(list(fileSignature(info)))
+
+    # Stored subdirectories of a directory which does not need to be listed, None if it does.
+    # `signature` is called to get the current signature of the directory when it is needed.
+    def skip(self, directory, signature):
+      with self.dbLock:
+        row = self.db.execute("SELECT walk, signature, subdirectories FROM directories WHERE path = ?", (directory,)).fetchone()
+      if row is None:
+        return None
+      walk, stored, subdirectories = row
+      if walk != self.walkId:
+        # without a modification time a change of the directory can not be seen
+        if not self.refresh or stored != signature() or json.loads(stored)[1] is None:
+          return None
+        # not changed since it was done, it is done in this walk as well
+        self.done(directory, stored, json.loads(subdirectories))
+      with self.lock:
+        self.skipped += 1
+      return json.loads(subdirectories)
+
+    # A file of the directory was queued
+    def found(self, path):
+      directory = path.rsplit('/', 1)[0]
+      with self.lock:
+        self.walking.setdefault(directory, [0, False, None, None])[0] += 1
+
+    # A queued file was finished, processed or not
+    def finished(self, path):
+      directory = path.rsplit('/', 1)[0]
+      with self.lock:
+        entry = self.walking.get(directory)
+        if entry is None:
+          return
+        entry[0] -= 1
+        if entry[0] > 0 or not entry[1]:
+          return
+        del self.walking[directory]
+      self.done(directory, entry[2], entry[3])
+
+    # The directory was listed, its files were all queued
+    def listed(self, directory, signature, subdirectories):
+      with self.lock:
+        entry = self.walking.setdefault(directory, [0, False, None, None])
+        entry[1:] = [True, signature, subdirectories]
+        if entry[0] > 0:
+          return
+        del self.walking[directory]
+      self.done(directory, signature, subdirectories)
+
+    def done(self, directory, signature, subdirectories):
+      with self.lock:
+        self.pending.append((directory, self.walkId, signature, json.dumps(subdirectories)))
+
+    def flush(self):
+      with self.lock:
+        batch, self.pending = self.pending, []
+      if batch:
+        with self.dbLock:
+          self.db.executemany("INSERT OR REPLACE INTO directories (path, walk, signature, subdirectories) VALUES (?, ?, ?, ?)", batch)
+          self.db.commit()
+        l.debug("Marked {} directories done".format(len(batch)))
+
+    def flushLoop(self):
+      while not self.stopped.wait(self.flushInterval):
+        try:
+          self.flush()
+        except sqlite3.Error as e:
+          l.info("Saving the walk state failed: {}".format(e))
+
+    # The whole tree was walked. Directories not seen in this walk do not exist any more.
+    def finish(self):
+      self.flush()
+      with self.dbLock:
+        removed = self.db.execute("DELETE FROM directories WHERE walk != ?", (self.walkId,)).rowcount
+        self.db.execute("UPDATE walks SET finished = ? WHERE id = ?", (time.time(), self.walkId))
+        self.db.commit()
+      l.info("Walk {} finished, {} directories not listed as they were done, {} removed directories forgotten".format(
+        self.walkId, self.skipped, removed))
+
+    def close(self):
+      self.stopped.set()
+      self.flusher.join()
+      self.flush()
+      with self.dbLock:
+        self.db.close()
@@ -1,151 +1,156 @@
 #!/usr/bin/env python3
 
-import os, sys, json, time
-import threading, Queue, concurrent.futures
-
-import requests
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-# Disable warnings about red https
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import os, sys, json, time, itertools
+import Queue
 
 # Onedatafs for data access
 from fs.onedatafs import OnedataFS
 
-# CTA Extractor
-from onedatacustom.metadataextractor import MetaDataExtractorHdf5
+# Shared ingestion building blocks
+from onedataingest.traversal import Walker, FoundFile
+from onedataingest.walkstate import WalkState
+from onedataingest.pipeline import Pipeline
+from onedataingest.stages import IngestionStages, stage
+from onedataingest.concurrency import AimdController
+from onedataingest.digests import IngestedFiles
+from onedataingest.fileindex import FileIndex
+from onedataingest.metrics import IngestionMetrics
+from onedataingest.extractpool import ExtractorPool
+from onedataingest.extractors import createRegistry
 
 # Configure logging
 import logging as l
 l.basicConfig(level=l.INFO, format='%(message)s')
 
-# Input parameters 
-onezoneUrl=os.environ['ONEZONE_HOST']
+# Input parameters
 sourceSpaceName=os.environ['SPACE_NAME']
 apiToken=os.environ['ONECLIENT_ACCESS_TOKEN']
 sourceProvider=os.environ['ONECLIENT_PROVIDER_HOST']
 insecure=os.environ['ONECLIENT_INSECURE']
-lastSeq=os.environ['LAST_SEQUENCE']
+# Directory of the space to traverse, the whole space by default
+traverseRoot='/{}/{}'.format(sourceSpaceName, os.environ.get('TRAVERSE_ROOT', '').strip('/')).rstrip('/')
+# Number of threads listing directories, how many directories may wait to be listed
+# and how many entries of a directory are listed at once
+traverseThreads=int(os.environ.get('TRAVERSE_THREADS', 8))
+traverseFrontier=int(os.environ.get('TRAVERSE_FRONTIER', 10000))
+traversePageSize=int(os.environ.get('TRAVERSE_PAGE_SIZE', 1000))
+# With WALK_STATE_PATH directories are marked done in this file. A walk interrupted
+# by a crash is continued without listing them again, with WALK_MODE=refresh a walk
+# after a finished one only lists directories which changed since, full lists all.
+walkStatePath=os.environ.get('WALK_STATE_PATH')
+walkMode=os.environ.get('WALK_MODE', 'resume')
+# Number of processes extracting metadata, 0 extracts in threads of the pipeline
+extractProcesses=int(os.environ.get('EXTRACT_PROCESSES', 0))
+# Files are read in blocks of this size, kept in a per file cache of READ_CACHE_BLOCKS blocks,
+# READ_AHEAD_BLOCKS following blocks are fetched together when a file is read sequentially.
+# Set READ_BLOCK_SIZE to 0 to read files directly.
+readerOptions=None
+if int(os.environ.get('READ_BLOCK_SIZE', 512 * 1024)) > 0:
+  readerOptions=dict(blockSize=int(os.environ.get('READ_BLOCK_SIZE', 512 * 1024)),
+                     readAhead=int(os.environ.get('READ_AHEAD_BLOCKS', 4)),
+                     maxBlocks=int(os.environ.get('READ_CACHE_BLOCKS', 64)))
+
+# Formats of files to ingest, the CTA extractor handles hdf5 files
+extractorNames=os.environ.get('EXTRACTORS', 'hdf5,fits').split(',')
+extractorOptions={ 'fits': dict(maxHdus=int(os.environ.get('FITS_MAX_HDUS', 32))),
+                   'json': dict(maxSize=int(os.environ.get('JSON_MAX_SIZE', 16 * 1024 * 1024))) }
+
+# Number of workers of each stage adapts to the latency of the provider, within <STAGE>_MIN_WORKERS
+# and <STAGE>_MAX_WORKERS. With ADAPTIVE_CONCURRENCY=false stages keep <STAGE>_WORKERS workers.
+adaptiveConcurrency=os.environ.get('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+
+# Port of the HTTP endpoint serving metrics in Prometheus format, 0 disables it
+metricsPort=int(os.environ.get('METRICS_PORT', 0))
+# Log timings of every processed file as a jsonLog line and of every listed directory as a dirLog line
+jsonLogEnabled=os.environ.get('JSON_LOG', 'true').lower() == 'true'
+
+# Initialize a bounded Queue for threads to communicate. When it is full
+# the walker stops listing directories until workers catch up
+BUF_SIZE = int(os.environ.get('QUEUE_SIZE', 1000))
+q = Queue.Queue(BUF_SIZE)
 
-# Space id will be inferred from Onezone based on space name
-spaceId=""
+# Log how long listing of each directory took
+def logDirectory(directory, files, subdirectories, listDirTime):
+  if not jsonLogEnabled:
+    return
+  dirLog = { "directory": directory, "files": files, "subdirectories": subdirectories, "listDirTime": listDirTime }
+  l.info("dirLog: {}".format(json.dumps(dirLog)))
 
-# Initialize a Queue for threads to communicate. 
-# During tests the queue never reached size more then 10k
-BUF_SIZE = 1000000
-q = Queue.Queue(BUF_SIZE)
+# Start extraction processes before OnedataFS and threads, as they are forked from this one
+extractorPool = None
+if extractProcesses > 0:
+  extractorPool = ExtractorPool(extractProcesses, extractorNames, extractorOptions,
+                                (sourceProvider, apiToken), dict(insecure=True, force_direct_io=True), readerOptions)
+
+# Extractors of the ingested formats, the walker picks files by their names
+extractors = createRegistry(extractorNames, extractorOptions)
 
-# Get spaceId from the space name
-with requests.Session() as session:
-  session.headers.update({'X-Auth-Token': apiToken })
-  url="{}/api/v3/onezone/user/spaces".format(onezoneUrl)
-  response = session.get(url,verify=False)
-
-  for space in response.json()['spaces']:
-    url="{}/api/v3/onezone/spaces/{}".format(onezoneUrl,space)
-    response = session.get(url,verify=False)
-    if response.json()['name'] == sourceSpaceName:
-      if spaceId=="":
-        spaceId=response.json()['spaceId']
-      else:
-        print("Error more then 1 space of name={} exists in the provider {}".format(sourceSpaceName,sourceProvider))
-        sys.exit(1)
-  if spaceId=="":
-    print("No space of name={} exists in the provider {}".format(sourceSpaceName,sourceProvider))
-    sys.exit(1)
-  print("Space name={} spaceId={}".format(sourceSpaceName,spaceId))
-
-# Changes stream is consumed in a separate thread
-class ChangesListener(threading.Thread):
-    def __init__(self, group=None, target=None, name=None,
-                 args=(), kwargs=None, verbose=None):
-        super(ChangesListener,self).__init__()
-        self.target = target
-        self.name = name
-
-    def run(self):
-      # Start listening the changes API
-      changesJSON='{ "fileMeta": { "fields": ["name", "type", "deleted"], "always": true }}'
-      while True:
-        with requests.Session() as session:
-          session.headers.update({'X-Auth-Token': apiToken })
-          session.headers.update({'content-type': 'application/json' })
-          url="https://{}/api/v3/oneprovider/changes/metadata/{}?timeout=60000&last_seq={}".format(sourceProvider,spaceId,lastSeq)
-          response = session.post(url,data=changesJSON,verify=False,stream=True)
-
-          lines = response.iter_lines()
-          for line in lines:
-            if line:
-                decoded_line = json.loads(line.decode('utf-8'))
-                if decoded_line["fileMeta"]["changed"] and not decoded_line["fileMeta"]["deleted"]:
-                  filePath=decoded_line['filePath']#.decode('utf-8')
-                  if filePath.lower().endswith("hdf5"):
-                    q.put(filePath)
-                    l.debug("Putting file {} to the queue".format(filePath))
-      return
-
-# Process items in the queue
-def traverse(root_path):
-  l.debug("Directory: {}".format(root_path))
-  while True:
-    if q.empty():
-      time.sleep(1)
-      print("No items in a queue.")
-    else:
-      with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        while not q.empty():
-          executor.submit(processPath, q.get(), root_path)
-
-# Process a single path
-def processPath(path,root_path):
-  try:
-    if path.endswith('.hdf5'):
-      wholeStart = time.time()
-      l.debug("Opening file: {}".format(path))
-      start = time.time() ; file = root_path.openbin(path,mode="r+") ; end = time.time() ; fileOpenTime=(end - start)
-      fileName = file.path
-      filePath = path
-      l.debug("Getting size of file: {}".format(path))
-      start = time.time() ; size = odfs.getinfo(fileName).size ; end = time.time() ; filegetInfoTime=(end - start)
-      l.debug("Size of file {} is: {}".format(path,size))
-      if size > 0:
-        l.debug("Extracting metadata from file: {}".format(path))
-        start = time.time() ; decoded_json = MetaDataExtractorHdf5(file).to_json() ; end = time.time() ; metadataExtractTime=(end - start)
-        l.debug("Attaching metadata to: {}".format(path))
-        start = time.time() ; odfs.setxattr(fileName,"onedata_json",json.dumps(decoded_json)) ; end = time.time() ; metadataSetOnedataFSTime=(end - start)
-        start = time.time() ; file.close() ; end = time.time() ; fileCloseTime=(end - start)
-        start = time.time() ; accessType=odfs.getxattr(fileName,b"org.onedata.access_type") ; end = time.time() ; getAccessTypeTime=(end - start)
-        l.debug("File={}, Access type={}, Metadata extract time={}, Metadata set with OnedataFS={}".format(filePath,accessType,metadataExtractTime,metadataSetOnedataFSTime))
-        jsonLog = {} ;
-        jsonLog["file"] = fileName ; jsonLog["metadataExtrationTime"] = metadataExtractTime ; jsonLog["accessType"] = str(accessType) ; jsonLog["metadataSettingTime"] = metadataSetOnedataFSTime ;
-        jsonLog['getAccessTypeTime'] = getAccessTypeTime ; jsonLog['filegetInfoTime'] = filegetInfoTime ; jsonLog['fileOpenTime'] = fileOpenTime ;  
-        jsonLog['fileCloseTime'] = fileCloseTime ; 
-        wholeEnd= time.time()
-        jsonLog['wholeTime'] = wholeEnd - wholeStart 
-        jsonLog['queueSize'] = q.qsize()
-        l.info("jsonLog: {}".format(json.dumps(jsonLog)))
-      else:
-        start = time.time() ; file.close() ; end = time.time() ; fileCloseTime=(end - start)
-        l.debug("size zero, omitting {}".format(file))
-    else:
-      l.debug("file does not match regex, omitting {}".format(path))
-  except Exception as e:
-    l.info(e)
+# Latency, throughput and backlog of the ingestion
+metrics = IngestionMetrics()
+
+# Files already ingested. With an index file they are remembered between
+# traversals, so files unchanged since the previous one are skipped
+indexPath = os.environ.get('INDEX_PATH')
+ingestedFiles = FileIndex(indexPath) if indexPath else IngestedFiles()
+
+# Directories done in walks of the space
+walkState = WalkState(walkStatePath, mode=walkMode) if walkStatePath else None
 
 # Initialize OnedataFS
 odfs = OnedataFS(sourceProvider, apiToken, insecure=True, force_direct_io=True)
-# Print list of user spaces 
+# Print list of user spaces
 l.debug(odfs.listdir('/'))
-# Open the space
-space = odfs.opendir('/{}'.format(sourceSpaceName))
+
+# Process found files with a pipeline of stages that run all the time,
+# files done are marked in the walk state
+stages = IngestionStages(odfs, extractors, ingestedFiles, metrics, extractorPool=extractorPool, readerOptions=readerOptions,
+                         onDone=(lambda task: walkState.finished(task.path)) if walkState else None,
+                         jsonLog=jsonLogEnabled, queue=q)
+pipeline = Pipeline(q, [
+  stage('open', stages.openFile, 2, 16, adaptive=adaptiveConcurrency),
+  # more threads than processes would only wait for the pool
+  stage('extract', stages.extractMetadata, extractProcesses or 2, extractProcesses or 8, adaptive=adaptiveConcurrency),
+  stage('attach', stages.attachMetadata, 2, 16, adaptive=adaptiveConcurrency),
+], onDone=stages.logTask)
+pipeline.start()
+if adaptiveConcurrency:
+  AimdController(pipeline.stages, interval=float(os.environ.get('ADAPT_INTERVAL', 10)),
+                 tolerance=float(os.environ.get('ADAPT_LATENCY_TOLERANCE', 2))).start()
+
+# Expose metrics of the ingestion
+metrics.watchQueue('found', q)
+metrics.watchPipeline(pipeline)
+if metricsPort: metrics.serve(metricsPort)
+
+# Files are queued as soon as they are found, files of formats not ingested are skipped
+counter = itertools.count()
+def onFile(path, info, listDirTime):
+  kind = extractors.forPath(path)
+  if kind:
+    if walkState: walkState.found(path)
+    q.put(FoundFile(next(counter), None, path, kind, info, listDirTime))
 
 # Start filling up the queue with files
-p = ChangesListener(name='producer')
-p.start()
+l.info("Traversing {}".format(traverseRoot))
+walker = Walker(odfs, onFile, threads=traverseThreads, maxFrontier=traverseFrontier, pageSize=traversePageSize,
+                onDirectory=logDirectory, state=walkState).start(traverseRoot)
+while not walker.join(60):
+  l.info("Traversal: {}".format(walker.progress()))
+l.info("Traversal ended: {}".format(walker.progress()))
 
-# Process items in the queue
-traverse(odfs)
+# All files are queued, let the workers finish them
+q.put(None)
+pipeline.join()
 
 # Close OnedataFS
 l.info("Processing ended. Closing onedatafs.")
+if indexPath: ingestedFiles.close()
+if walkState:
+  if walker.errors == 0:
+    walkState.finish()
+  else:
+    l.info("Listing of {} directories failed, the next run continues the walk".format(walker.errors))
+  walkState.close()
+if extractorPool: extractorPool.close()
 odfs.close()
-sys.exit(0)
\ No newline at end of file
+sys.exit(0)
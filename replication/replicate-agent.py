@@ -0,0 +1,655 @@
+#!/usr/bin/env python3
+#
+# Replicates files of a space from one Oneprovider to another as they change.
+#
+# Same as replicate-agent.sh, with the same options. Files changed in the
+# changes stream of the source provider are deferred until nothing happens
+# to them for --defer-time seconds, then their transfer to the destination
+# provider is requested. Deferred files are kept in memory, indexed by path,
+# with a heap of their deadlines, so a change or a due transfer costs
+# O(log pending files) instead of a rewrite of the whole cache file. They are
+# saved in an append-only log, compacted once it is mostly outdated, and
+# loaded from it when the agent starts again.
+#
+# Transfers are requested by a few threads with limits on running transfers
+# and on the request rate, then followed until they end; failed ones are
+# retried with a growing delay. Many files of one directory due together
+# are replicated with a single request for the directory.
+
+import os, sys, json, time, heapq, signal, argparse, threading
+try:
+  from urllib import quote
+except ImportError:
+  from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+# Disable warnings about red https
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+# Configure logging
+import logging as l
+l.basicConfig(level=l.INFO, format='%(message)s')
+
+EXAMPLES = """
+The simplest way to initalize the replication of data on space 'par-n-lis-c' from provider 'paris' to provider 'lisbon':
+  %(prog)s --oz develop-onezone.develop.svc.dev.onedata.uk.to \\
+           --sp develop-oneprovider-paris.develop.svc.dev.onedata.uk.to \\
+           --dp develop-oneprovider-lisbon.develop.svc.dev.onedata.uk.to \\
+           --sn par-n-lis-c -t MDAxNWxvY2F0...
+
+If user has 2 spaces named 'par-n-lis-c' supply the space id with --sid instead of the space name.
+By default replication starts from the latest changes in the space, use --seq 100 to start from the change
+numbered 100. With --seq-save the number following the last received change is saved to ./last_seq and read
+from it when the agent starts again. Files waiting for their transfer are kept in --cache.
+
+With --env parameters not given as options are taken from the environment variables onezone_url,
+source_space_name, source_space_id, source_provider, target_provider and api_token.
+"""
+
+# Variables read with --env, as in replicate-agent.sh
+ENVIRONMENT = { 'oz': 'onezone_url', 'sn': 'source_space_name', 'sid': 'source_space_id',
+                'sp': 'source_provider', 'dp': 'target_provider', 'token': 'api_token' }
+
+def stripUrl(url):
+  for prefix in ("https://", "http://", "www."):
+    if url.startswith(prefix):
+      url = url[len(prefix):]
+  return url.split('/')[0]
+
+# Sequence number, name, path and id of a regular file changed by an event, None for other events.
+# Events of the changes/metadata stream come either flat (deleted, changes.type, file_path, file_id)
+# or with the file attributes in fileMeta (filePath, fileId).
+def parseEvent(event):
+  if "fileMeta" in event:
+    fileMeta = event["fileMeta"]
+    fields = fileMeta.get("fields", {})
+    if not fileMeta.get("changed", True) or fileMeta.get("deleted") or fields.get("deleted"):
+      return None
+    if fields.get("type", "REG") != "REG":
+      return None
+    filePath = event.get("filePath")
+    name = fields.get("name") or (filePath or "").rsplit('/', 1)[-1]
+    return int(event["seq"]), name, filePath, event.get("fileId")
+  if event.get("deleted") is not False or event.get("changes", {}).get("type") != "REG":
+    return None
+  return int(event["seq"]), event.get("name"), event.get("file_path"), event.get("file_id")
+
+# Sequence number and change (see parseEvent) of a line of the changes stream,
+# ValueError if the line is not an event
+def decodeEvent(line):
+  try:
+    event = json.loads(line.decode('utf-8'))
+    return int(event["seq"]), parseEvent(event)
+  except (KeyError, TypeError, AttributeError) as e:
+    raise ValueError("not an event ({!r})".format(e))
+
+# Directory of a path, None for files known only by their id
+def parentOf(path):
+  if not path.startswith('/'):
+    return None
+  return path.rsplit('/', 1)[0] or '/'
+
+# Files waiting for their transfer until nothing happens to them for `deferTime` seconds.
+#
+# Each file is indexed by its path and has an entry in a min-heap of
+# deadlines. A change of a deferred file only pushes a new heap entry with
+# a newer version, entries of older versions are dropped when they come up.
+# A file taken for transfer is in flight until its transfer ends; if it
+# changes meanwhile, it is deferred again once the transfer ends. Files
+# are also indexed by their directory, with the number of files deferred
+# anywhere below each directory, so all due files of a directory can be
+# taken at once. Every change and transfer is appended to the log at
+# `path`. When the log holds more than twice as many records as files
+# deferred (and at least `compactMin`), it is rewritten with the deferred
+# files only.
+class PendingTransfers(object):
+    def __init__(self, path, deferTime, compactMin=1000):
+      self.path = path
+      self.deferTime = deferTime
+      self.compactMin = compactMin
+      self.lock = threading.Condition()
+      # path -> file record, with the version of its newest change and when it is due
+      self.index = {}
+      # (deadline, version, path)
+      self.heap = []
+      # path -> version of the file being transferred
+      self.inFlight = {}
+      # directory -> paths of deferred files in it
+      self.children = {}
+      # directory -> number of deferred files below it
+      self.below = {}
+      self.version = 0
+      self.logLines = 0
+      # scheduling loaded files notifies waiters of the lock
+      with self.lock:
+        self.load()
+      self.log = open(self.path, "a")
+      if self.logLines > len(self.index):
+        self.compact()
+
+    def load(self):
+      if not os.path.exists(self.path):
+        return
+      records = {}
+      with open(self.path) as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # cut short by a crash
+            continue
+          self.logLines += 1
+          if record.pop("op") == "done":
+            records.pop(record["path"], None)
+          else:
+            records[record["path"]] = record
+      for record in records.values():
+        self.add(record)
+      if self.index:
+        l.info("Loaded {} files waiting for transfer from {}".format(len(self.index),self.path))
+
+    def add(self, record):
+      path = record["path"]
+      if path not in self.index:
+        directory = parentOf(path)
+        if directory is not None:
+          self.children.setdefault(directory, set()).add(path)
+        while directory is not None:
+          self.below[directory] = self.below.get(directory, 0) + 1
+          directory = None if directory == '/' else parentOf(directory)
+      self.version += 1
+      record["version"] = self.version
+      self.index[path] = record
+      if path not in self.inFlight:
+        self.schedule(record, record["time"] + self.deferTime)
+
+    def remove(self, path):
+      del self.index[path]
+      directory = parentOf(path)
+      if directory is not None:
+        self.children[directory].discard(path)
+        if not self.children[directory]:
+          del self.children[directory]
+      while directory is not None:
+        self.below[directory] -= 1
+        if not self.below[directory]:
+          del self.below[directory]
+        directory = None if directory == '/' else parentOf(directory)
+
+    def schedule(self, record, deadline):
+      record["due"] = deadline
+      heapq.heappush(self.heap, (deadline, record["version"], record["path"]))
+      self.lock.notify()
+
+    def append(self, op, record):
+      line = dict((key, value) for key, value in record.items() if key not in ("version", "due", "attempts"))
+      line["op"] = op
+      self.log.write(json.dumps(line) + "\n")
+      self.log.flush()
+      self.logLines += 1
+      if self.logLines > max(self.compactMin, 2 * len(self.index)):
+        self.compact()
+
+    def compact(self):
+      with open(self.path + ".tmp", "w") as f:
+        for record in self.index.values():
+          line = dict((key, value) for key, value in record.items() if key not in ("version", "due", "attempts"))
+          line["op"] = "defer"
+          f.write(json.dumps(line) + "\n")
+      self.log.close()
+      os.rename(self.path + ".tmp", self.path)
+      self.log = open(self.path, "a")
+      l.debug("Compacted {} from {} to {} records".format(self.path,self.logLines,len(self.index)))
+      self.logLines = len(self.index)
+
+    # Defer the transfer of a changed file, True if it was not deferred yet
+    def touch(self, path, seq, name, fileId):
+      with self.lock:
+        new = path not in self.index
+        record = { "path": path, "time": time.time(), "seq": seq, "name": name, "fileId": fileId }
+        self.add(record)
+        self.append("defer", record)
+        return new
+
+    # Wait for the next file due for transfer and take it, None once stopped
+    def next(self, stopped):
+      with self.lock:
+        while not stopped.is_set():
+          while self.heap:
+            deadline, version, path = self.heap[0]
+            record = self.index.get(path)
+            if record is not None and record["version"] == version and path not in self.inFlight:
+              break
+            # the file changed again, is being transferred or was transferred since
+            heapq.heappop(self.heap)
+          now = time.time()
+          if self.heap and self.heap[0][0] <= now:
+            deadline, version, path = heapq.heappop(self.heap)
+            self.inFlight[path] = version
+            return dict(self.index[path])
+          self.lock.wait(min(self.heap[0][0] - now, 1) if self.heap else 1)
+      return None
+
+    # Take the other due files of the directory of a taken file, when at least `threshold`
+    # files are due there and no other file below the directory is waiting for its transfer
+    def takeDirectory(self, record, threshold):
+      directory = parentOf(record["path"])
+      with self.lock:
+        if threshold <= 0 or directory is None or self.below.get(directory, 0) < threshold:
+          return []
+        now = time.time()
+        due = [self.index[path] for path in self.children[directory]
+               if path not in self.inFlight and self.index[path]["due"] <= now]
+        if len(due) + 1 < threshold or len(due) + 1 != self.below[directory]:
+          return []
+        for other in due:
+          self.inFlight[other["path"]] = other["version"]
+        return [dict(other) for other in due]
+
+    # The transfer ended, the file is forgotten unless it changed meanwhile
+    def done(self, record):
+      with self.lock:
+        self.inFlight.pop(record["path"], None)
+        current = self.index.get(record["path"])
+        if current is None:
+          return
+        if current["version"] == record["version"]:
+          self.remove(record["path"])
+          self.append("done", { "path": record["path"] })
+        else:
+          self.schedule(current, current["time"] + self.deferTime)
+
+    # The transfer failed, it is requested again after `delay` seconds, or later if the file changed meanwhile
+    def retry(self, record, delay):
+      with self.lock:
+        self.inFlight.pop(record["path"], None)
+        current = self.index.get(record["path"])
+        if current is None:
+          return
+        if current["version"] == record["version"]:
+          current["attempts"] = record.get("attempts", 0) + 1
+          self.schedule(current, time.time() + delay)
+        else:
+          self.schedule(current, current["time"] + self.deferTime)
+
+    def __len__(self):
+      with self.lock:
+        return len(self.index)
+
+    def close(self):
+      with self.lock:
+        self.log.close()
+
+# Limits the rate of requests to `rate` per second, allowing bursts of `burst` requests
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+      self.rate = rate
+      self.burst = burst or max(1, rate)
+      self.tokens = self.burst
+      self.updated = time.time()
+      self.lock = threading.Lock()
+
+    def take(self):
+      if self.rate <= 0:
+        return
+      while True:
+        with self.lock:
+          now = time.time()
+          self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+          self.updated = now
+          if self.tokens >= 1:
+            self.tokens -= 1
+            return
+          wait = (1 - self.tokens) / self.rate
+        time.sleep(wait)
+
+# Transfer states of the Oneprovider API, by outcome
+SUCCEEDED = ("completed", "skipped")
+FAILED = ("failed", "cancelled")
+
+# Requests transfers of files when they are due and follows them until they end.
+#
+# `submitters` threads request transfers, at most `maxTransfers` of them
+# run at a time and all requests to the provider are limited to `rate` per
+# second. When `directoryThreshold` files of one directory are due together
+# and nothing else below it waits, the whole directory is replicated with
+# one request. Running transfers are polled every `pollInterval` seconds.
+# A transfer which could not be requested or failed is requested again
+# after `retryDelay` seconds, doubled with every failure up to `maxBackoff`.
+class TransferDispatcher(object):
+    def __init__(self, session, sourceProvider, targetProviderId, pending, retryDelay, maxTransfers=20, rate=10,
+                 directoryThreshold=10, pollInterval=5, maxBackoff=300, submitters=4, replicasLog=None):
+      self.session = session
+      self.sourceProvider = sourceProvider
+      self.targetProviderId = targetProviderId
+      self.pending = pending
+      self.retryDelay = retryDelay
+      self.maxTransfers = maxTransfers
+      self.bucket = TokenBucket(rate)
+      self.directoryThreshold = directoryThreshold
+      self.pollInterval = pollInterval
+      self.maxBackoff = maxBackoff
+      self.submitters = submitters
+      self.replicasLog = replicasLog
+      self.logLock = threading.Lock()
+      self.lock = threading.Condition()
+      # transfer id -> records of files it transfers
+      self.active = {}
+      # transfers being requested, they count as running
+      self.submitting = 0
+      self.stopped = threading.Event()
+      self.threads = []
+
+    def start(self):
+      for i in range(self.submitters):
+        self.spawn(self.submit, "submitter-{}".format(i))
+      self.spawn(self.poll, "poller")
+      return self
+
+    def spawn(self, target, name):
+      thread = threading.Thread(target=target, name=name)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+    def stop(self):
+      self.stopped.set()
+      with self.lock:
+        self.lock.notify_all()
+
+    def join(self, timeout=None):
+      for thread in self.threads:
+        thread.join(timeout)
+
+    def backoff(self, record):
+      return min(self.maxBackoff, self.retryDelay * 2 ** record.get("attempts", 0))
+
+    def request(self, method, url):
+      self.bucket.take()
+      with self.logLock:
+        if self.replicasLog:
+          self.replicasLog.write("{} {}\n".format(method, url))
+      response = self.session.request(method, url, headers={'Content-type': 'application/json'}, timeout=60)
+      with self.logLock:
+        if self.replicasLog:
+          self.replicasLog.write(response.text + "\n")
+          self.replicasLog.flush()
+      return response.json()
+
+    def submit(self):
+      while not self.stopped.is_set():
+        with self.lock:
+          while len(self.active) + self.submitting >= self.maxTransfers and not self.stopped.is_set():
+            self.lock.wait(1)
+          self.submitting += 1
+        try:
+          record = self.pending.next(self.stopped)
+          if record is None:
+            return
+          records = [record] + self.pending.takeDirectory(record, self.directoryThreshold)
+          transferId = self.transfer(records)
+          if transferId:
+            with self.lock:
+              self.active[transferId] = records
+          else:
+            print("No trasnfer id recived. This request will be retried.")
+            for record in records:
+              self.pending.retry(record, self.backoff(record))
+        finally:
+          with self.lock:
+            self.submitting -= 1
+            self.lock.notify()
+
+    def transfer(self, records):
+      if len(records) > 1:
+        directory = parentOf(records[0]["path"])
+        print("Requested directory transfer: <{}>".format(directory))
+        print("  changed files: <{}>".format(len(records)))
+        url = "https://{}/api/v3/oneprovider/replicas{}?provider_id={}".format(self.sourceProvider,quote(directory),self.targetProviderId)
+      else:
+        record = records[0]
+        print("Requested file transfer: <{}>".format(record["name"]))
+        print("  change stream number: <{}>".format(record["seq"]))
+        print("  path: <{}>".format(record["path"]))
+        print("  id: <{}>".format(record["fileId"]))
+        url = "https://{}/api/v3/oneprovider/replicas-id/{}?provider_id={}".format(self.sourceProvider,record["fileId"],self.targetProviderId)
+      try:
+        transferId = self.request("POST", url).get("transferId")
+      except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+        l.info("Requesting transfer of {} failed: {}".format(records[0]["path"] if len(records) == 1 else directory, e))
+        transferId = None
+      print("  replication transfer id: {}".format(transferId))
+      print("")
+      return transferId
+
+    # Check states of all running transfers every pollInterval seconds
+    def poll(self):
+      while not self.stopped.wait(self.pollInterval):
+        with self.lock:
+          active = list(self.active.items())
+        for transferId, records in active:
+          try:
+            transfer = self.request("GET", "https://{}/api/v3/oneprovider/transfers/{}".format(self.sourceProvider,transferId))
+          except (requests.exceptions.RequestException, ValueError) as e:
+            l.debug("Checking transfer {} failed: {}".format(transferId,e))
+            continue
+          state = transfer.get("replicationStatus") or transfer.get("transferStatus") or transfer.get("status")
+          if state in SUCCEEDED:
+            l.info("Transfer {} of {} files {}".format(transferId,len(records),state))
+            for record in records:
+              self.pending.done(record)
+          elif state in FAILED:
+            l.info("Transfer {} of {} files {}, it will be retried".format(transferId,len(records),state))
+            for record in records:
+              self.pending.retry(record, self.backoff(record))
+          else:
+            continue
+          with self.lock:
+            del self.active[transferId]
+            self.lock.notify()
+
+def parseArguments():
+  parser = argparse.ArgumentParser(description="This script helps to preform data replication between two Oneproviders.",
+                                   epilog=EXAMPLES, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--oz", help="onezone url")
+  parser.add_argument("--sn", help="space name")
+  parser.add_argument("--sid", help="instead of space name you can supply space id. space id takes precedence over --sn")
+  parser.add_argument("--sp", help="url or name of replicaton source oneprovider")
+  parser.add_argument("--dp", help="url or name of replicaton destination oneprovider")
+  parser.add_argument("-t", dest="token", help="onezone API token")
+  parser.add_argument("--seq", type=int, help="space change event sequence id from which you will start receiving events")
+  parser.add_argument("--seq-save", "--save-seq", dest="seqSave", action="store_true",
+                      help="save the sequence number following the last received event to the file ./last_seq, "
+                           "when starting read the sequence number from it")
+  parser.add_argument("--cache-freq", dest="cacheFreq", type=float, default=2,
+                      help="how long (in seconds) to wait before retrying a failed transfer, doubled with every "
+                           "failure of it (default: 2 seconds)")
+  parser.add_argument("--max-transfers", dest="maxTransfers", type=int, default=20,
+                      help="how many transfers may run at once (default: 20)")
+  parser.add_argument("--rate", type=float, default=10,
+                      help="how many requests per second may be sent to the source provider, 0 for no limit (default: 10)")
+  parser.add_argument("--dir-threshold", dest="directoryThreshold", type=int, default=10,
+                      help="replicate the whole directory when this many files in it are due together, 0 disables it (default: 10)")
+  parser.add_argument("--poll-freq", dest="pollFreq", type=float, default=5,
+                      help="how often (in seconds) states of running transfers are checked (default: 5 seconds)")
+  parser.add_argument("--max-backoff", dest="maxBackoff", type=float, default=300,
+                      help="longest delay (in seconds) before retrying a failed transfer (default: 300 seconds)")
+  parser.add_argument("--cache", default="cache.log", help="file keeping files waiting for their transfer (default: cache.log)")
+  parser.add_argument("--log-stream", dest="logStream", action="store_true", help="log raw stream of changes to stream.log")
+  parser.add_argument("--log-replicas", dest="logReplicas", action="store_true",
+                      help="log raw stream of requests and responses to the replicasion API replicas.log")
+  parser.add_argument("--env", action="store_true", help="try to get all needed parameters from the environment")
+  parser.add_argument("--defer-time", dest="deferTime", type=float, default=180,
+                      help="how long (in seconds) to wait before scheduling transfer of a modified file since the last "
+                           "activity on it. Default: 180 seconds")
+  parser.add_argument("--debug", action="store_true", help="additional data transfer information")
+  options = parser.parse_args()
+  if options.env:
+    for option, variable in ENVIRONMENT.items():
+      if getattr(options, option) is None:
+        setattr(options, option, os.environ.get(variable))
+
+  errors = []
+  if not options.oz:
+    errors.append("ERROR: Missign onezone url.")
+  if not options.sn and not options.sid:
+    errors.append("ERROR: You must supply space name or space id.")
+  if not options.sp:
+    errors.append("ERROR: Missign source provider name or url.")
+  if not options.dp:
+    errors.append("ERROR: Missign target provider name or url.")
+  if not options.token:
+    errors.append("ERROR: Missign onezone api token.")
+  if errors:
+    print("\n".join(errors))
+    print("Please see --help, study examples and supply needed parameters.")
+    sys.exit(1)
+  options.oz = "https://{}".format(stripUrl(options.oz))
+  options.sp = stripUrl(options.sp)
+  options.dp = stripUrl(options.dp)
+  return options
+
+# Space id of the space of the given name, exits unless there is exactly one
+def findSpace(session, onezoneUrl, spaceName):
+  matched = []
+  for spaceId in session.get("{}/api/v3/onezone/user/spaces".format(onezoneUrl)).json()["spaces"]:
+    if session.get("{}/api/v3/onezone/spaces/{}".format(onezoneUrl,spaceId)).json()["name"] == spaceName:
+      matched.append(spaceId)
+  if not matched:
+    print("No space with name <{}> found in onezone <{}>".format(spaceName,onezoneUrl))
+    sys.exit(1)
+  if len(matched) > 1:
+    print("Found 2 or more spaces with name <{}> found in onezone <{}>:".format(spaceName,onezoneUrl))
+    for spaceId in matched:
+      print("Space name: <{}> , space id: <{}>".format(spaceName,spaceId))
+    print("Cannot decide which one to use. Exiting.")
+    sys.exit(1)
+  return matched[0]
+
+# Ids of the source and target providers among providers supporting the space
+def findProviders(session, options, spaceId):
+  space = session.get("{}/api/v3/onezone/spaces/{}".format(options.oz,spaceId)).json()
+  print("  Information about space\n")
+  print("    Space name: <{}>".format(space["name"]))
+  print("    Space id: <{}>".format(space["spaceId"]))
+  sourceProviderId = targetProviderId = None
+  for providerId, supportSize in space["providers"].items():
+    provider = session.get("{}/api/v3/onezone/providers/{}".format(options.oz,providerId)).json()
+    print("    Provider <{}>".format(provider["name"]))
+    print("      with id <{}>".format(providerId))
+    print("      domain url <{}>".format(provider["domain"]))
+    print("      suppots space <{}> with storage size of <{}> bytes".format(space["name"],supportSize))
+    if provider["domain"] in options.sp:
+      sourceProviderId = providerId
+    if provider["domain"] in options.dp:
+      targetProviderId = providerId
+  print("")
+  if targetProviderId is None:
+    print("ERROR: <{}> did not match any of the providers that supports the space <{}>".format(options.dp,space["name"]))
+    sys.exit(1)
+  if sourceProviderId is None:
+    print("ERROR: <{}> did not match any of the providers that supports the space <{}>".format(options.sp,space["name"]))
+    sys.exit(1)
+  return space["name"], sourceProviderId, targetProviderId
+
+def saveSeq(seq):
+  with open("last_seq.tmp", "w") as f:
+    f.write("{}\n".format(seq))
+  os.rename("last_seq.tmp", "last_seq")
+
+def loadSeq():
+  try:
+    with open("last_seq") as f:
+      return int(f.read())
+  except (IOError, OSError, ValueError):
+    return None
+
+def terminate(signum, frame):
+  raise KeyboardInterrupt()
+
+def main():
+  options = parseArguments()
+  if options.debug:
+    l.getLogger().setLevel(l.DEBUG)
+
+  # One pool of keep-alive connections for all requests
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_maxsize=8, max_retries=3)
+  session.mount('https://', adapter)
+  session.headers.update({'X-Auth-Token': options.token})
+  session.verify = False
+
+  spaceId = options.sid or findSpace(session, options.oz, options.sn)
+  spaceName, sourceProviderId, targetProviderId = findProviders(session, options, spaceId)
+  print("  Replication information\n")
+  print("    Starting monitoring of changes of space <{}>, on provider <{}>.".format(spaceName,options.sp))
+  print("    All changess will be replicated to provider <{}> that also supports space <{}>\n".format(options.dp,spaceName))
+
+  pending = PendingTransfers(options.cache, options.deferTime)
+  replicasLog = open("replicas.log", "a") if options.logReplicas else None
+  streamLog = open("stream.log", "a") if options.logStream else None
+  dispatcher = TransferDispatcher(session, options.sp, targetProviderId, pending, options.cacheFreq,
+                                  maxTransfers=options.maxTransfers, rate=options.rate,
+                                  directoryThreshold=options.directoryThreshold, pollInterval=options.pollFreq,
+                                  maxBackoff=options.maxBackoff, replicasLog=replicasLog).start()
+
+  lastSeq = options.seq
+  if lastSeq is None and options.seqSave:
+    lastSeq = loadSeq()
+  if lastSeq is not None:
+    print("    Requesting stream of changes from the event number <{}>:\n".format(lastSeq))
+  else:
+    print("    Subscribing to the stream of changes:\n")
+
+  signal.signal(signal.SIGTERM, terminate)
+  savedAt = 0
+  try:
+    while True:
+      url = "https://{}/api/v3/oneprovider/changes/metadata/{}?timeout=60000".format(options.sp,spaceId)
+      if lastSeq is not None:
+        url += "&last_seq={}".format(lastSeq)
+      try:
+        response = session.get(url, stream=True, timeout=120)
+        response.raise_for_status()
+        for line in response.iter_lines():
+          if not line:
+            continue
+          if streamLog:
+            streamLog.write(line.decode('utf-8', 'replace') + "\n")
+          try:
+            seq, change = decodeEvent(line)
+          except ValueError as e:
+            # the stream goes on after an event which can not be used
+            l.info("Skipping event after seq={} which could not be parsed ({}): {}".format(
+              lastSeq,e,line[:200].decode('utf-8', 'replace')))
+            continue
+          if change is not None:
+            _, name, filePath, fileId = change
+            l.debug("parsed: {} {} {} {}".format(seq,name,filePath,fileId))
+            new = pending.touch(filePath or fileId, seq, name, fileId)
+            l.debug("{} file transfer: <{}>, if no changes to this file occures for {} [s] its transfer will be enqueued.".format(
+              "New" if new else "Updated", filePath, options.deferTime))
+          # resume right after this event, a change is safely deferred by now
+          lastSeq = seq + 1
+          if options.seqSave and time.time() - savedAt >= 1:
+            saveSeq(lastSeq)
+            savedAt = time.time()
+      except (requests.exceptions.RequestException, ValueError) as e:
+        l.info("Changes stream interrupted ({}), reconnecting".format(e))
+        time.sleep(1)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    dispatcher.stop()
+    if options.seqSave and lastSeq is not None:
+      saveSeq(lastSeq)
+    dispatcher.join(5)
+    pending.close()
+    for log in (replicasLog, streamLog):
+      if log:
+        log.close()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# Tests of replicate-agent.py, run with: python -m unittest discover replication
+
+import os, sys, time, shutil, tempfile, unittest
+
+# Load the agent script as a module, its name is not a valid module name
+agentPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replicate-agent.py")
+try:
+  import importlib.util
+  spec = importlib.util.spec_from_file_location("replicateagent", agentPath)
+  agent = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(agent)
+except ImportError:
+  import imp
+  agent = imp.load_source("replicateagent", agentPath)
+
+class PendingTransfersRestartTest(unittest.TestCase):
+    def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.path = os.path.join(self.directory, "cache.log")
+
+    def tearDown(self):
+      shutil.rmtree(self.directory)
+
+    def test_restart_replays_log(self):
+      pending = agent.PendingTransfers(self.path, deferTime=0)
+      for i in range(3):
+        pending.touch("/space/dir/file{}".format(i), i + 1, "file{}".format(i), None)
+      pending.close()
+
+      # files deferred before the restart are waiting for their transfer again
+      pending = agent.PendingTransfers(self.path, deferTime=0)
+      self.assertEqual(len(pending), 3)
+      self.assertEqual(sorted(pending.index), ["/space/dir/file{}".format(i) for i in range(3)])
+      pending.close()
+
+    def test_restart_forgets_transferred_files(self):
+      pending = agent.PendingTransfers(self.path, deferTime=0)
+      pending.touch("/space/a", 1, "a", None)
+      pending.touch("/space/b", 2, "b", None)
+      pending.done(pending.index["/space/a"])
+      pending.close()
+
+      pending = agent.PendingTransfers(self.path, deferTime=0)
+      self.assertEqual(sorted(pending.index), ["/space/b"])
+      pending.close()
+
+class DecodeEventTest(unittest.TestCase):
+    def test_file_change(self):
+      line = b'{"seq": 7, "deleted": false, "changes": {"type": "REG"}, "name": "a", "file_path": "/space/a", "file_id": "id"}'
+      self.assertEqual(agent.decodeEvent(line), (7, (7, "a", "/space/a", "id")))
+
+    def test_other_event(self):
+      self.assertEqual(agent.decodeEvent(b'{"seq": 8, "deleted": true}'), (8, None))
+
+    def test_unusable_lines(self):
+      for line in (b'{"deleted": false, "changes": {"type": "REG"}}', b'{"seq": 9, "fileMeta": {"fields": ', b'[1, 2]',
+                   b'{"seq": "x"}', b'{"seq": 10, "fileMeta": "deleted"}'):
+        self.assertRaises(ValueError, agent.decodeEvent, line)
+
+if __name__ == "__main__":
+  unittest.main()